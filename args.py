@@ -2,20 +2,35 @@ import json
 import os
 import time
 from abc import abstractmethod, ABCMeta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional, Union
 from pydoc import locate
 from argparse import ArgumentParser
 
 import pandas as pd
 from bitarray import bitarray
+from cryptography.exceptions import InvalidTag
 from pandas import DataFrame
+from rich.console import Console
+from rich.table import Table
 
 from cipher.asymmetric import RSASimple
-from cipher.block import BBSCipher, CBCMode, CTRMode
+from cipher.block import BBSCipher, CBCMode, CTRMode, CustomMode
+from cipher.hybrid import HybridCipher
 from generators.bbs import BBS
-from tests.bench import BenchBlockCipher
-from tests.test import bbs_run_tests
-from utils.blum import generate_blum_integer
+from generators.sequence import Sequence, open_sequence, text_to_binary, binary_to_text
+from tests.bench import BenchBatch, BenchBlockCipher, BenchCustomModes, BenchModeScaling, BenchRSA
+from tests.campaign import run_campaign
+from tests.nist import nist_run_tests
+from tests.online import WindowedFIPS
+from tests.test import bbs_run_tests, fips_battery
+from utils.batch_gcd import load_moduli, shared_factors
+from utils.blum import generate_blum_factors, write_blum_key
+from utils.pool import PrimePool, PrimeSpec, RefillWorker
+from utils.private import open_private
+
+console = Console()
 
 
 def get_subcommands() -> dict[str:"Subcommand"]:
@@ -26,6 +41,8 @@ def get_subcommands() -> dict[str:"Subcommand"]:
         "bench": SubcommandBench(),
         "modes": SubcommandModes(),
         "rsa": SubcommandRSA(),
+        "pool": SubcommandPool(),
+        "batch-gcd": SubcommandBatchGCD(),
     }
 
 
@@ -65,24 +82,40 @@ class Subcommand(metaclass=ABCMeta):
 
 class SubcommandTest(Subcommand):
     def run(self, args, unknown_args):
-        if args.bbs:
-            with open(args.file_path, "r") as f:
-                bbs = f.read()
-            bbs_run_tests(bbs)
+        if args.bbs and args.windows:
+            if args.suite != "fips":
+                raise ValueError("the windows campaign runs the FIPS 140-2 battery only")
+            with open_sequence(args.file_path, BBS.read_blum_integer(required=False)) as sequence:
+                results = run_campaign(sequence, args.stride, args.workers)
+            if args.json:
+                print(results.to_json())
+            else:
+                console.print(results.table())
+        elif args.bbs:
+            with open_sequence(args.file_path, BBS.read_blum_integer(required=False)) as sequence:
+                # FIPS reads only the selected 20000 bit range, NIST the whole sequence without copying it
+                self._run_suite(args, sequence if args.suite == "fips" else sequence.view())
         if args.bbs_cipher:
             if len(unknown_args) == 0:
                 raise AttributeError("provide a message or a path to a file containing message")
-            msg = " ".join(unknown_args)
+            msg = " ".join(unknown_args).encode("utf-8")
             if os.path.exists(unknown_args[0]):
-                with open(unknown_args[0], "r") as f:
+                with open(unknown_args[0], "rb") as f:
                     msg = f.read()
-            cipher = BBSCipher(args.file_path)
-            cipher.run(msg)
+            with BBSCipher(args.file_path) as cipher:
+                cipher.run(msg)
 
             bits = bitarray()
             bits.frombytes(cipher.encrypted)
 
-            bbs_run_tests(bits.to01())
+            self._run_suite(args, bits)
+
+    @staticmethod
+    def _run_suite(args, bits: Union[bitarray, Sequence]):
+        if args.suite == "nist":
+            nist_run_tests(bits, args.nist_tests.split(",") if args.nist_tests else None)
+        else:
+            bbs_run_tests(bits)
 
 
 class SubcommandBench(Subcommand):
@@ -90,8 +123,18 @@ class SubcommandBench(Subcommand):
 
     def run(self, args, unknown_args):
         results: list[DataFrame] = []
+        timing = {"repeat": args.repeat, "warmup": args.warmup, "min_time": args.min_time}
         for path, data in self._read_files(args).items():
-            results.append(BenchBlockCipher(path, data).run())
+            if args.block_cipher or not (args.rsa or args.custom_modes or args.scaling or args.batch):
+                results.append(BenchBlockCipher(path, data, **timing).run())
+            if args.custom_modes:
+                results.append(BenchCustomModes(path, data, **timing).run())
+            if args.scaling:
+                results.append(BenchModeScaling(path, data, max_workers=args.workers, **timing).run())
+            if args.batch:
+                results.append(BenchBatch(path, data, **timing).run())
+            if args.rsa:
+                results.append(BenchRSA(path, data, **timing).run())
 
         df = pd.concat(results, ignore_index=True)
         if args.output == "excel":
@@ -126,60 +169,222 @@ class SubcommandBench(Subcommand):
 
 class SubcommandGenerateBlumInt(Subcommand):
     def run(self, args, unknown_args):
+        p, q = generate_blum_factors(p_len=args.p_len, q_len=args.q_len, workers=args.workers,
+                                    pool=None if args.no_pool else PrimePool())
         with open("numbers/blum.integer", "w") as f:
-            f.write(str(generate_blum_integer(p_len=args.p_len, q_len=args.q_len)))
+            f.write(str(p * q))
+        write_blum_key(p, q)
 
 
 class SubcommandBBS(Subcommand):
     def run(self, args, unknown_args):
         if args.generate:
-            seq = BBS.new(args.seq_len)
-            if seq:
-                seq_path = Path('./sequence')
-                if not seq_path.exists():
-                    seq_path.mkdir(parents=True, exist_ok=True)
-                with open(seq_path.joinpath(f"{time.time_ns()}.{args.seq_len}.bbs"), "w") as f:
-                    f.write(seq)
+            seq_path = Path('./sequence')
+            if not seq_path.exists():
+                seq_path.mkdir(parents=True, exist_ok=True)
+            online_tests = WindowedFIPS() if args.test else None
+            path = BBS.new(args.seq_len, seq_path.joinpath(f"{time.time_ns()}.{args.seq_len}.bbs"),
+                           args.bits_per_step, offset=args.offset, workers=args.workers, seed=args.seed,
+                           observer=online_tests.update if online_tests else None)
+            if path and online_tests:
+                results = online_tests.results()
+                if len(results.starts) == 1:
+                    fips_battery(online_tests.last_stats).run()
+                else:
+                    console.print(results.table())
         if args.cipher:
             if len(unknown_args) == 0:
                 raise AttributeError("provide a message or a path to a file containing message")
-            msg = " ".join(unknown_args)
-            if os.path.exists(unknown_args[0]):
-                with open(unknown_args[0], "r") as f:
-                    msg = f.read()
-            BBSCipher(args.file_path).run(msg)
+            with BBSCipher(args.file_path, args.key_offset) as cipher:
+                if args.out_path:
+                    if not os.path.exists(unknown_args[0]):
+                        raise AttributeError("provide a path to a file containing message to write the output to -o")
+                    written = cipher.encrypt_file(unknown_args[0], args.out_path)
+                    console.print(f"[bold magenta]Ciphered[/bold magenta] {written} bytes into {args.out_path}, "
+                                  f"next key offset: {cipher.key_offset}")
+                else:
+                    msg = " ".join(unknown_args).encode("utf-8")
+                    if os.path.exists(unknown_args[0]):
+                        with open(unknown_args[0], "rb") as f:
+                            msg = f.read()
+                    cipher.run(msg)
+        if args.convert:
+            if not args.file_path or not args.out_path:
+                raise AttributeError("provide the source sequence with -f and the converted sequence path with -o")
+            if args.convert == "binary":
+                text_to_binary(args.file_path, args.out_path)
+            else:
+                binary_to_text(args.file_path, args.out_path)
 
 
 class SubcommandModes(Subcommand):
 
     def run(self, args, unknown_args):
-        with open(args.file_path, "r") as f:
-            data = f.read().encode(encoding="utf-8")
+        executor = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+        key = self._read_key(args.key_path) if args.out_path else None
+        if args.out_path and key is None and args.decrypt:
+            console.print(f"[bold red]No key to decrypt with:[/bold red] {args.key_path} does not exist")
+            return
 
         mode = None
         if args.cbc:
-            mode = CBCMode()
+            mode = CBCMode(args.workers, executor, key)
         if args.ctr:
-            mode = CTRMode()
+            mode = CTRMode(args.workers, executor, key)
         if mode is None:
             raise ValueError("unknown mode provided")
 
+        if args.out_path:
+            if key is None:
+                self._write_key(mode.black_box.key, args.key_path)
+            self._run_file(mode, args)
+            return
+
+        with open(args.file_path, "r") as f:
+            data = f.read().encode(encoding="utf-8")
         mode.run(data, args.boo_boo)
 
+    @staticmethod
+    def _run_file(mode: CustomMode, args):
+        """ Encrypt (or decrypt) the whole file, binary or not, to out_path a chunk at a time """
+        try:
+            if args.decrypt:
+                written = mode.decrypt_file(args.file_path, args.out_path, args.chunk_size)
+            else:
+                written = mode.encrypt_file(args.file_path, args.out_path, args.chunk_size)
+        except ValueError as e:
+            console.print(f"[bold red]Decryption failed:[/bold red] {e}")
+            return
+        console.print(f"[bold magenta]Written {written} bytes to:[/bold magenta] {args.out_path}")
+
+    @staticmethod
+    def _read_key(path: str) -> Optional[bytes]:
+        try:
+            with open(path, "r") as f:
+                return bytes.fromhex(f.read().strip())
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_key(key: bytes, path: str):
+        with open_private(path) as f:
+            f.write(key.hex())
+        console.print(f"[bold magenta]Key saved to:[/bold magenta] {path}")
+
 
 class SubcommandRSA(Subcommand):
 
     def run(self, args, unknown_args):
-        with open(args.file_path, "r") as f:
-            data = f.read().encode(encoding="utf-8")
         if args.simple:
-            simple_rsa = RSASimple()
+            simple_rsa = RSASimple(workers=args.workers, pool=None if args.no_pool else PrimePool(),
+                                   key_size=args.key_size, public_exponent=args.public_exponent,
+                                   chunk_blocks=args.chunk_blocks, primes=args.primes)
 
             if args.preset_file:
                 with open(args.preset_file, "r") as f:
                     simple_rsa.with_preset(f.read())
 
+            if args.out_path:
+                self._run_file(simple_rsa, args)
+                return
+
+            with open(args.file_path, "rb") as f:
+                data = f.read()
             if args.encrypt:
                 simple_rsa.run_encryption(data)
             if args.sign:
                 simple_rsa.run_signing(data)
+            if args.save_preset and simple_rsa.preset:
+                self._save_preset(simple_rsa, args.save_preset)
+
+    def _run_file(self, simple_rsa: RSASimple, args):
+        """ Encrypt (or decrypt) the whole file to out_path in constant memory, RSA only or hybrid """
+        if not simple_rsa.preset:
+            if args.decrypt or not args.save_preset:
+                console.print("[bold red]A preset is required:[/bold red] pass --with-preset, "
+                              "or --save-preset to keep a new one for encryption")
+                return
+            simple_rsa.preset = simple_rsa.generate_preset()
+            self._save_preset(simple_rsa, args.save_preset)
+
+        engine = HybridCipher(simple_rsa) if args.hybrid else simple_rsa
+        try:
+            if args.decrypt:
+                written = engine.decrypt_file(args.file_path, args.out_path)
+            else:
+                written = engine.encrypt_file(args.file_path, args.out_path)
+        except (ValueError, InvalidTag) as e:
+            console.print(f"[bold red]Decryption failed:[/bold red] {str(e) or 'authentication tag does not match'}")
+            return
+        console.print(f"[bold magenta]Written {written} bytes to:[/bold magenta] {args.out_path}")
+
+    @staticmethod
+    def _save_preset(simple_rsa: RSASimple, path: str):
+        with open_private(path) as f:
+            json.dump(simple_rsa.preset, f)
+        console.print(f"[bold magenta]Preset saved to:[/bold magenta] {path}")
+
+
+class SubcommandPool(Subcommand):
+
+    def run(self, args, unknown_args):
+        pool = PrimePool()
+        residue, modulus = (3, 4) if args.blum else (args.residue, args.modulus)
+        specs = [PrimeSpec(length, residue, modulus) for length in args.bits or []]
+
+        if args.fill:
+            for spec in specs:
+                added = pool.refill(spec, args.watermark, args.workers)
+                console.print(f"[bold magenta]{spec.key}:[/bold magenta] added {added} primes")
+        if args.watch:
+            worker = RefillWorker(pool, specs, args.watermark, args.interval, args.workers)
+            worker.start()
+            console.log(f"Keeping {len(specs)} pools at {args.watermark} primes, press Ctrl+C to stop")
+            try:
+                while worker.is_alive():
+                    worker.join(timeout=1.0)
+            except KeyboardInterrupt:
+                worker.stop()
+
+        table = Table(title=f"Prime pool at {pool.path}")
+        table.add_column("Length", justify="right", style="cyan")
+        table.add_column("Class", style="cyan")
+        table.add_column("Primes", justify="right", style="magenta")
+        for spec in pool.specs():
+            table.add_row(str(spec.length), f"{spec.residue} mod {spec.modulus}", str(pool.size(spec)))
+        console.print(table)
+
+
+class SubcommandBatchGCD(Subcommand):
+
+    def run(self, args, unknown_args):
+        paths = args.file_paths.split(",") if args.file_paths else [args.dir_path]
+        found = load_moduli(paths)
+        moduli = list(found.keys())
+        pairs = shared_factors(moduli, args.spill_dir)
+        # the same modulus stored more than once (e.g. in blum.integer and blum.key) is the same key
+        duplicates = [labels for labels in found.values() if len(labels) > 1]
+
+        if args.json:
+            print(json.dumps({
+                "moduli": len(moduli),
+                "shared_factors": [{"a": found[moduli[i]], "b": found[moduli[j]], "factor": g,
+                                    "a_cofactor": moduli[i] // g, "b_cofactor": moduli[j] // g}
+                                   for i, j, g in pairs],
+                "duplicates": duplicates,
+            }))
+            return
+
+        console.print(f"[bold magenta]Scanned {len(moduli)} distinct moduli[/bold magenta]")
+        table = Table(title=f"{len(pairs)} pairs of moduli sharing a factor")
+        table.add_column("Modulus A", style="cyan")
+        table.add_column("Modulus B", style="cyan")
+        table.add_column("Shared factor", style="red")
+        table.add_column("Cofactor A", style="magenta")
+        table.add_column("Cofactor B", style="magenta")
+        for i, j, g in pairs:
+            table.add_row(", ".join(found[moduli[i]]), ", ".join(found[moduli[j]]), str(g),
+                          str(moduli[i] // g), str(moduli[j] // g))
+        console.print(table)
+        for labels in duplicates:
+            console.print(f"[yellow]Same modulus in:[/yellow] {', '.join(labels)}")
@@ -1,20 +1,44 @@
 import json
-from random import randint
+from math import gcd, lcm, prod
+from random import randrange
+from itertools import chain, islice
+from typing import BinaryIO, Iterable, Iterator, Optional, Union
 
 from rich import print_json
 from rich.console import Console
 from rich.table import Table
 
-from utils.base import decimal_to_base, base_to_decimal
-from utils.prime import generate_prime_number, generate_coprime_random_integer
+from utils.parallel import ordered_map
+from utils.pool import PrimePool, PrimeSpec
+from utils.prime import generate_primes, modular_inverse
 
 console = Console()
 
 
 class RSASimple:
 
-    def __init__(self):
+    def __init__(self, workers: int = 1, pool: Optional[PrimePool] = None, key_size: int = 2048,
+                 public_exponent: int = 65537, chunk_blocks: int = 64, primes: int = 2):
+        if primes < 2:
+            raise ValueError(f"a key needs at least 2 primes, was: {primes}")
+        if key_size < 8 * primes:
+            raise ValueError(f"key size must be at least {8 * primes} bits for {primes} primes, was: {key_size}")
+        if public_exponent < 3 or public_exponent % 2 == 0:
+            raise ValueError(f"public exponent must be an odd integer greater than 2, was: {public_exponent}")
         self.preset = None
+        # bit length of n
+        self.key_size = key_size
+        self.public_exponent = public_exponent
+        # number of prime factors of n, the primes beyond p and q go to the "other_primes" of the preset
+        self.primes = primes
+        # processes searching for the primes of a new preset and transforming the blocks
+        self.workers = workers
+        # blocks sent to a worker at once, inputs of a single chunk are transformed in place
+        self.chunk_blocks = chunk_blocks
+        # pre-generated primes, taken before searching for new ones
+        self.pool = pool
+        # CRT parameters of the presets which passed the self-check, None if it failed, keyed by n
+        self._crt: dict[int, Optional[tuple]] = {}
 
     def run_encryption(self, msg: bytes):
         if not self.preset:
@@ -31,7 +55,7 @@ class RSASimple:
 [bold]Input:[/bold]
 [blue]{str(msg).lstrip('b')}[/blue]
 [bold]Encrypted:[/bold]
-[red]{encrypted}[/red]
+[red]{encrypted.hex()}[/red]
 [bold]Decrypted:[/bold]
 [green]{str(decrypted).lstrip('b')}[/green]
 """)
@@ -49,10 +73,10 @@ class RSASimple:
 
         # correct decryption
         results = [
-            ["A", preset_a["d"], self.decrypt(encrypted_a, "e", preset=preset_a), "A", preset_a["e"]],
-            ["B", preset_b["d"], self.decrypt(encrypted_b, "e", preset=preset_b), "B", preset_b["e"]],
-            ["A", preset_a["d"], self.decrypt(encrypted_a, "e", preset=preset_b), "B", preset_b["e"]],
-            ["B", preset_b["d"], self.decrypt(encrypted_b, "e", preset=preset_a), "A", preset_a["e"]],
+            ["A", preset_a["d"], self._verify(encrypted_a, preset=preset_a), "A", preset_a["e"]],
+            ["B", preset_b["d"], self._verify(encrypted_b, preset=preset_b), "B", preset_b["e"]],
+            ["A", preset_a["d"], self._verify(encrypted_a, preset=preset_b), "B", preset_b["e"]],
+            ["B", preset_b["d"], self._verify(encrypted_b, preset=preset_a), "A", preset_a["e"]],
         ]
 
         table = Table(title="Signing results")
@@ -73,52 +97,205 @@ class RSASimple:
         console.line(1)
         console.print(table)
 
-    def encrypt(self, msg: bytes, key: str, preset: dict = None) -> list[int]:
+    def _verify(self, signed: bytes, preset: dict) -> Union[bytes, str]:
+        """ The signed message recovered with the public key, a note if it does not decode (wrong key) """
+        try:
+            return self.decrypt(signed, "e", preset=preset)
+        except ValueError:
+            return "[red]invalid signature[/red]"
+
+    def encrypt(self, msg: bytes, key: str, preset: dict = None) -> bytes:
+        """ Pad the message and raise every block_sizes(n)[0] bytes to the key exponent
+            return the concatenated, fixed width (block_sizes(n)[1] bytes) output blocks
+        """
         if preset is None:
             preset = self.preset
+        block_size, enc_block_size = self.block_sizes(preset["n"])
+        padded = ISO7816.add_padding(msg, block_size)
+        return b"".join(self._transform(_split(padded, block_size * self.chunk_blocks), key, preset,
+                                        block_size, enc_block_size))
 
-        encrypted = []
-        for m in decimal_to_base(int.from_bytes(msg, "big"), preset["n"]):
-            c = pow(m, preset[key], preset["n"])
-            encrypted.append(c)
-        return encrypted
+    def decrypt(self, enc: bytes, key: str, preset: dict = None) -> bytes:
+        """ Reverse encrypt, ValueError if the blocks were not encrypted with the matching key """
+        if preset is None:
+            preset = self.preset
+        block_size, enc_block_size = self.block_sizes(preset["n"])
+        return ISO7816.rm_padding(b"".join(self._transform(_split(enc, enc_block_size * self.chunk_blocks), key,
+                                                           preset, enc_block_size, block_size)))
 
-    def decrypt(self, enc: list[int], key: str, preset: dict = None) -> bytes:
+    def encrypt_stream(self, src: BinaryIO, dst: BinaryIO, key: str, preset: dict = None) -> int:
+        """ encrypt, chunk_blocks blocks at a time, only the last (short) chunk is padded
+            return the number of bytes written
+        """
         if preset is None:
             preset = self.preset
+        block_size, enc_block_size = self.block_sizes(preset["n"])
+        chunks = _read_padded(src, block_size * self.chunk_blocks, block_size)
+        return sum(dst.write(out) for out in self._transform(chunks, key, preset, block_size, enc_block_size))
+
+    def decrypt_stream(self, src: BinaryIO, dst: BinaryIO, key: str, preset: dict = None) -> int:
+        """ decrypt, chunk_blocks blocks at a time, the last block is held back until the padding can be removed
+            return the number of bytes written
+        """
+        if preset is None:
+            preset = self.preset
+        block_size, enc_block_size = self.block_sizes(preset["n"])
+        chunks = iter(lambda: src.read(enc_block_size * self.chunk_blocks), b"")
+        written = 0
+        last = b""
+        for plain in self._transform(chunks, key, preset, enc_block_size, block_size):
+            written += dst.write(last) + dst.write(memoryview(plain)[:-block_size])
+            last = plain[-block_size:]
+        return written + dst.write(ISO7816.rm_padding(last))
+
+    def encrypt_file(self, src_path: str, dst_path: str, key: str = "e", preset: dict = None) -> int:
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            return self.encrypt_stream(src, dst, key, preset)
 
-        decrypted: list[int] = []
-        for c in enc:
-            m = pow(c, preset[key], preset["n"])
-            decrypted.append(m)
+    def decrypt_file(self, src_path: str, dst_path: str, key: str = "d", preset: dict = None) -> int:
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            return self.decrypt_stream(src, dst, key, preset)
 
-        msg_int = base_to_decimal(decrypted, preset["n"])
-        return msg_int.to_bytes((msg_int.bit_length() + 7) // 8, "big")
+    @staticmethod
+    def block_sizes(n: int) -> tuple[int, int]:
+        """ Bytes of an input block, the most for which every value is lower than n, and of an output block """
+        return (n.bit_length() - 1) // 8, (n.bit_length() + 7) // 8
+
+    def _transform(self, chunks: Iterable[bytes], key: str, preset: dict, in_size: int,
+                   out_size: int) -> Iterator[bytes]:
+        """ Raise every block of every chunk to the key exponent, in a pool of workers processes when there is
+            more than a single chunk, the transformed chunks are yielded in order
+        """
+        n = preset["n"]
+        crt = self._crt_parameters(preset) if key == "d" else None
+        jobs = ((chunk, in_size, out_size, n, preset[key], crt) for chunk in chunks)
+        head = list(islice(jobs, 2))
+        if self.workers <= 1 or len(head) < 2:
+            return map(_transform_blocks, chain(head, jobs))
+        return ordered_map(_transform_blocks, chain(head, jobs), self.workers)
+
+    def _crt_parameters(self, preset: dict) -> Optional[tuple]:
+        """ (p, q, dp, dq, qinv, ((r, d, t), ...)) of the preset, None if it has no factors or they do not check """
+        n = preset["n"]
+        if n in self._crt:
+            return self._crt[n]
+        if "p" not in preset or "q" not in preset:
+            return None
+
+        p, q, d = preset["p"], preset["q"], preset["d"]
+        # presets saved before the CRT parameters were added only hold the factors
+        others = tuple((r["r"], r["d"], r["t"]) for r in preset.get("other_primes", []))
+        crt = (p, q, preset.get("dp", d % (p - 1)), preset.get("dq", d % (q - 1)),
+               preset.get("qinv", modular_inverse(q, p)), others)
+        # self-check against the plain path, the preset is only used through the CRT if both agree
+        x = randrange(2, n - 1)
+        if prod((p, q, *(r for r, _, _ in others))) != n or self._crt_pow(x, *crt) != pow(x, d, n):
+            console.log("[yellow]CRT parameters of the preset do not match its private key, using the plain path")
+            crt = None
+        self._crt[n] = crt
+        return crt
+
+    @staticmethod
+    def _crt_pow(x: int, p: int, q: int, dp: int, dq: int, qinv: int, others: tuple = ()) -> int:
+        """ x^d mod n from an exponentiation modulo every prime, recombined with Garner's formula (RFC 8017, 5.1.2)
+            Args:
+                others -- tuple -- (r, d mod (r - 1), (p·q·...)^-1 mod r) for every prime beyond p and q
+        """
+        m_p = pow(x, dp, p)
+        m_q = pow(x, dq, q)
+        h = qinv * (m_p - m_q) % p
+        m = m_q + h * q
+        product = p * q
+        for r, d_r, t in others:
+            h = (pow(x, d_r, r) - m) * t % r
+            m += product * h
+            product *= r
+        return m
 
     def with_preset(self, data: str):
         self.preset = json.loads(data)
 
     def generate_preset(self) -> dict:
-        # choose two random 4-digit primes
-        p = generate_prime_number(self._rnd_int())
-        q = generate_prime_number(self._rnd_int())
-        while p == q:
-            q = generate_prime_number(self._rnd_int())
-        # calculate n by multiplying them both
-        n = p * q
-        # calculate φ(n) = (p – 1)(q – 1)
-        phi_n = (p - 1) * (q - 1)
-        # generate e, as a coprime to φ(n)
-        e = generate_coprime_random_integer(phi_n, self._rnd_int())
-        # generate d, so that e·d is congruent to modulo of φ(n)
-        d = 0
-        while d == 0:
-            proposed_d = randint(1, phi_n)
-            if (e * proposed_d - 1) % phi_n == 0:
-                d = proposed_d
-
-        return {"p": p, "q": q, "n": n, "phi": phi_n, "e": e, "d": d}
+        """ Generate a key of self.key_size bits and self.primes primes with the public exponent self.public_exponent
+            return the preset holding both keys and the CRT parameters (dp, dq, qinv, other_primes) of the private one
+        """
+        e = self.public_exponent
+        # the lengths of the primes add up to key_size, the two most significant bits of each are set
+        specs = [PrimeSpec(self.key_size // self.primes + (i < self.key_size % self.primes))
+                 for i in range(self.primes)]
+        primes = []
+        for spec, r in zip(specs, self._primes(specs)):
+            # e must be invertible modulo λ(n), the primes for which it is not are dropped; n of more than two
+            # primes may still be a bit short, the last prime is then drawn again
+            while gcd(e, r - 1) != 1 or r in primes or \
+                    (len(primes) == len(specs) - 1 and (prod(primes) * r).bit_length() != self.key_size):
+                r, = self._primes([spec])
+            primes.append(r)
+        p, q, *others = primes
+        # calculate n by multiplying them all
+        n = prod(primes)
+        # λ(n) = lcm(p - 1, q - 1, ...), the smallest exponent valid for d (φ(n) is a multiple of it)
+        phi_n = prod(r - 1 for r in primes)
+        lambda_n = lcm(*(r - 1 for r in primes))
+        # d is the inverse of e modulo λ(n)
+        d = modular_inverse(e, lambda_n)
+
+        preset = {"p": p, "q": q, "n": n, "phi": phi_n, "lambda": lambda_n, "e": e, "d": d,
+                  "dp": d % (p - 1), "dq": d % (q - 1), "qinv": modular_inverse(q, p)}
+        if others:
+            # RFC 8017 OtherPrimeInfo, t is the inverse of the product of all the preceding primes modulo r
+            preset["other_primes"] = [{"r": r, "d": d % (r - 1), "t": modular_inverse(prod(primes[:i + 2]), r)}
+                                      for i, r in enumerate(others)]
+        return preset
+
+    def _primes(self, specs: list[PrimeSpec]) -> list[int]:
+        if self.pool:
+            return self.pool.draw(specs, self.workers)
+        return generate_primes([spec.as_tuple() for spec in specs], self.workers)
+
+
+def _split(data: bytes, size: int) -> Iterator[bytes]:
+    for offset in range(0, len(data), size):
+        yield data[offset:offset + size]
+
+
+def _read_padded(src: BinaryIO, size: int, block_size: int) -> Iterator[bytes]:
+    """ Chunks of size bytes read from src, the last (short or empty) one is padded """
+    chunk = src.read(size)
+    while len(chunk) == size:
+        yield chunk
+        chunk = src.read(size)
+    yield ISO7816.add_padding(chunk, block_size)
+
+
+def _transform_blocks(args: tuple[bytes, int, int, int, int, Optional[tuple]]) -> bytes:
+    """ Raise every in_size bytes block of data to the exponent modulo n, through the CRT parameters if given
+        return the out_size bytes blocks, ValueError if a result does not fit (it was transformed with another key)
+    """
+    data, in_size, out_size, n, exponent, crt = args
+    if len(data) % in_size:
+        raise ValueError(f"data length must be a multiple of {in_size}, was: {len(data)}")
+    view = memoryview(data)
+    out = bytearray(len(data) // in_size * out_size)
+    for i, offset in enumerate(range(0, len(data), in_size)):
+        x = int.from_bytes(view[offset:offset + in_size], "big")
+        y = RSASimple._crt_pow(x, *crt) if crt else pow(x, exponent, n)
+        if y.bit_length() > 8 * out_size:
+            raise ValueError("transformed block is out of range, the data was encrypted with another key")
+        out[i * out_size:(i + 1) * out_size] = y.to_bytes(out_size, "big")
+    return bytes(out)
+
+
+class ISO7816:
+    """ ISO/IEC 7816-4 padding, a 0x80 byte followed by zeros, works with blocks of any size """
+
+    @staticmethod
+    def add_padding(data: bytes, block_size: int) -> bytes:
+        return data + b"\x80" + bytes(block_size - 1 - len(data) % block_size)
 
     @staticmethod
-    def _rnd_int() -> int:
-        return randint(10, 11)
+    def rm_padding(data: bytes) -> bytes:
+        end = len(data.rstrip(b"\x00")) - 1
+        if end < 0 or data[end] != 0x80:
+            raise ValueError("invalid padding")
+        return data[:end]
@@ -1,42 +1,65 @@
 import os
+import tempfile
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Type, Union
 
+import numpy as np
 from bitarray import bitarray
 from cryptography.hazmat.primitives.ciphers import modes, algorithms, Cipher
 from rich.console import Console
 from rich.markdown import Markdown
 
 from cipher.booboo import BooBoo
+from generators.bbs import BBS
+from generators.sequence import open_sequence
+from utils.parallel import ordered_map
 
 console = Console()
 
 
 class BBSCipher:
     encoding = "utf-8"
+    # size of the plaintext window XORed at once by the streaming path
+    CHUNK_SIZE = 1 << 20
 
     encrypted = b""
 
-    def __init__(self, bbs_file_path: str):
-        if not bbs_file_path:
-            raise ValueError("provide file path to BBS sequence with -f")
-        with open(bbs_file_path, "r") as f:
-            self._key = bitarray(f.read())
+    def __init__(self, bbs_file_path: str, key_offset: int = 0):
+        self._key = open_sequence(bbs_file_path, BBS.read_blum_integer(required=False))
+        # index of the first keystream bit to be used, advanced by the streaming path
+        self.key_offset = key_offset
 
-    def run(self, msg: str):
-        console.print(f"IN:  {msg}", style="blue")
+    def close(self):
+        """ Release the key sequence """
+        self._key.close()
+
+    def __enter__(self) -> "BBSCipher":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, msg: Union[str, bytes]):
+        if isinstance(msg, str):
+            msg = msg.encode(self.encoding)
+        console.print(f"IN:  {msg.decode(self.encoding, errors='replace')}", style="blue", markup=False)
 
         encrypted = self.encrypt(msg)
         pretty_enc = str(encrypted).lstrip('b').strip("'")
-        console.print(f"ENC: {pretty_enc}", style="red")
+        console.print(f"ENC: {pretty_enc}", style="red", markup=False)
 
         self.encrypted = encrypted
 
         decrypted = self.decrypt(encrypted)
-        console.print(f"DEC: {decrypted.decode('utf-8')}", style="yellow")
+        console.print(f"DEC: {decrypted.decode(self.encoding, errors='replace')}", style="yellow", markup=False)
 
-    def encrypt(self, msg: str) -> bytes:
+    def encrypt(self, msg: Union[str, bytes]) -> bytes:
+        if isinstance(msg, str):
+            msg = msg.encode(self.encoding)
         msg_bits = bitarray()
-        msg_bits.frombytes(msg.encode(self.encoding))
+        msg_bits.frombytes(msg)
         return self._xor_both(msg_bits)
 
     def decrypt(self, ciphered: bytes) -> bytes:
@@ -44,21 +67,47 @@ class BBSCipher:
         ciphered_bits.frombytes(ciphered)
         return self._xor_both(ciphered_bits)
 
-    def _xor_both(self, msg_bits: bitarray) -> bytes:
-        if len(self._key) < len(msg_bits):
-            raise AttributeError(f"BBS sequence should be at least as long as the bit form of the message"
-                                 f", was: {len(msg_bits)} vs. key: {len(self._key)}")
+    def encrypt_stream(self, src: BinaryIO, dst: BinaryIO, chunk_size: int = CHUNK_SIZE) -> int:
+        """ XOR src against the keystream chunk by chunk, writing the result to dst as it goes.
+            Both the chunk and the matching key window are XORed in place in a single reusable buffer,
+            the key offset is advanced past the consumed keystream.
+            return number of bytes written
+        """
+        buf = bytearray(chunk_size)
+        written = 0
+        while read := src.readinto(buf):
+            window = bitarray(buffer=memoryview(buf)[:read], endian="big")
+            self._check_key_length(self.key_offset + len(window))
+            window ^= self._key.bits(self.key_offset, self.key_offset + len(window))
+            dst.write(memoryview(buf)[:read])
+            self.key_offset += len(window)
+            written += read
+            del window
+        return written
+
+    decrypt_stream = encrypt_stream
+
+    def encrypt_file(self, src_path: str, dst_path: str, chunk_size: int = CHUNK_SIZE) -> int:
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            return self.encrypt_stream(src, dst, chunk_size)
+
+    decrypt_file = encrypt_file
 
-        key_bits = self._key
-        if len(self._key) > len(msg_bits):
-            key_bits = self._key[:len(msg_bits)]
+    def _xor_both(self, msg_bits: bitarray) -> bytes:
+        self._check_key_length(self.key_offset + len(msg_bits))
+        return (msg_bits ^ self._key.bits(self.key_offset, self.key_offset + len(msg_bits))).tobytes()
 
-        return (msg_bits ^ key_bits).tobytes()
+    def _check_key_length(self, required: int):
+        if len(self._key) < required:
+            raise AttributeError(f"BBS sequence should be at least as long as the bit form of the message"
+                                 f" from the key offset, was: {required} vs. key: {len(self._key)}")
 
 
 class BlockCipher:
     enc_data: str = ""
     dec_data: str = ""
+    # bytes read at once by the streaming methods
+    CHUNK_SIZE = 1 << 20
 
     def __init__(self, algorithm: algorithms.CipherAlgorithm, mode: modes.Mode, data: bytes):
         self.tag = None
@@ -78,31 +127,273 @@ class BlockCipher:
         else:
             self.dec_data = decryptor.update(self.enc_data) + decryptor.finalize()
 
+    def encrypt_chunks(self, src: Union[BinaryIO, Iterable[bytes]],
+                       chunk_size: int = CHUNK_SIZE) -> Iterator[memoryview]:
+        """ encrypt src chunk by chunk, the data passed to the constructor is not used; the tag of an authenticated
+            mode is kept in self.tag once the iterator is exhausted
+            Args:
+                src -- Union[BinaryIO, Iterable[bytes]] -- a file object read chunk_size bytes at a time, or bytes-like
+                    chunks, the longer ones are split
+                chunk_size -- int -- largest number of bytes transformed at once
+            return iterator over the ciphertext, views of a single reusable buffer, each one only valid until the
+            next one is requested
+        """
+        encryptor = self._streaming_cipher().encryptor()
+        yield from self._update_into(encryptor, _input_chunks(src, chunk_size), chunk_size)
+        if final := encryptor.finalize():
+            yield memoryview(final)
+        if isinstance(self.cipher.mode, modes.ModeWithAuthenticationTag):
+            self.tag = encryptor.tag
+
+    def decrypt_chunks(self, src: Union[BinaryIO, Iterable[bytes]], length: int = -1,
+                       chunk_size: int = CHUNK_SIZE) -> Iterator[memoryview]:
+        """ decrypt length bytes of src (everything if negative) chunk by chunk, see encrypt_chunks; an authenticated
+            mode is verified against self.tag at the end, InvalidTag is raised if it does not match, the data
+            yielded up to that point must then be discarded
+        """
+        decryptor = self._streaming_cipher().decryptor()
+        yield from self._update_into(decryptor, _input_chunks(src, chunk_size, length), chunk_size)
+        if isinstance(self.cipher.mode, modes.ModeWithAuthenticationTag):
+            final = decryptor.finalize_with_tag(self.tag)
+        else:
+            final = decryptor.finalize()
+        if final:
+            yield memoryview(final)
+
+    def encrypt_stream(self, src: BinaryIO, dst: BinaryIO, chunk_size: int = CHUNK_SIZE) -> int:
+        """ encrypt everything left in src to dst, see encrypt_chunks
+            return the number of bytes written
+        """
+        return sum(dst.write(chunk) for chunk in self.encrypt_chunks(src, chunk_size))
+
+    def decrypt_stream(self, src: BinaryIO, dst: BinaryIO, length: int = -1, chunk_size: int = CHUNK_SIZE) -> int:
+        """ decrypt length bytes of src (everything left if negative) to dst, see decrypt_chunks
+            return the number of bytes written
+        """
+        return sum(dst.write(chunk) for chunk in self.decrypt_chunks(src, length, chunk_size))
+
+    def _streaming_cipher(self) -> Cipher:
+        if isinstance(self.cipher.mode, modes.XTS):
+            # every update call would be a data unit of its own, encrypted with the same tweak
+            raise ValueError("XTS cannot be streamed, the whole data unit has to be passed at once")
+        return self.cipher
+
+    def _update_into(self, context, chunks: Iterator[memoryview], chunk_size: int) -> Iterator[memoryview]:
+        # update_into asks for up to a block more than the input
+        out = memoryview(bytearray(chunk_size + getattr(self.cipher.algorithm, "block_size", 8) // 8 - 1))
+        for chunk in chunks:
+            yield out[:context.update_into(chunk, out)]
+
+
+class BatchCipher:
+    """ Many small records under the same key, each one with its own IV or nonce, transformed in a single call
+
+        The records are packed one after the other in a single buffer, record i being
+        out[offsets[i]:offsets[i + 1]], the tag of an authenticated mode is appended to its record. CTR encrypts
+        the counter blocks of the whole batch with a single ECB call, the other modes reuse the algorithm and
+        a single output buffer but need a context per record
+    """
+
+    def __init__(self, algorithm: algorithms.CipherAlgorithm, mode: Type[modes.Mode]):
+        """ Args:
+                algorithm -- algorithms.CipherAlgorithm -- algorithm and key
+                mode -- Type[modes.Mode] -- mode class, instantiated with the IV or nonce of every record
+        """
+        if mode is modes.XTS:
+            raise ValueError("XTS records need a tweak and a data unit of their own, use BlockCipher")
+        self.algorithm = algorithm
+        self.mode = mode
+        self._tag_size = 16 if issubclass(mode, modes.ModeWithAuthenticationTag) else 0
+        self._block_size = getattr(algorithm, "block_size", 8) // 8
+        # the key schedule of the CTR path is set up once
+        self._ecb = Cipher(algorithm, modes.ECB()).encryptor() if mode is modes.CTR and self._block_size == 16 else None
+
+    def encrypt_batch(self, messages: Iterable[bytes], ivs: Optional[Iterable[bytes]] = None) \
+            -> tuple[bytearray, np.ndarray]:
+        """ Args:
+                messages -- Iterable[bytes] -- the records
+                ivs -- Optional[Iterable[bytes]] -- IV or nonce of every record, None for ECB
+            return the packed ciphertexts (tags appended) and the len(messages) + 1 offsets of the records
+        """
+        return self._transform(messages, ivs, encrypt=True)
+
+    def decrypt_batch(self, data: bytes, offsets: Iterable[int], ivs: Optional[Iterable[bytes]] = None) \
+            -> tuple[bytearray, np.ndarray]:
+        """ Decrypt the records packed by encrypt_batch, InvalidTag is raised for the first record of an
+            authenticated mode which does not match its tag
+            return the packed messages and their offsets
+        """
+        data = memoryview(data)
+        offsets = list(offsets)
+        return self._transform((data[start:end] for start, end in zip(offsets, offsets[1:])), ivs, encrypt=False)
+
+    def _transform(self, records: Iterable[bytes], ivs: Optional[Iterable[bytes]], encrypt: bool) \
+            -> tuple[bytearray, np.ndarray]:
+        records = list(records)
+        ivs = [None] * len(records) if ivs is None else list(ivs)
+        if len(ivs) != len(records):
+            raise ValueError(f"every record needs its IV or nonce, got {len(ivs)} for {len(records)} records")
+
+        if not encrypt and self._tag_size:
+            for i, record in enumerate(records):
+                if len(record) < self._tag_size:
+                    raise ValueError(f"record {i}: {len(record)} bytes cannot hold the {self._tag_size} byte tag, "
+                                     f"the record is truncated")
+        if self._ecb:
+            # the counters are built from the raw nonces, the library would not get to check them
+            for i, nonce in enumerate(ivs):
+                if nonce is None or len(nonce) != self._block_size:
+                    got = "none" if nonce is None else f"{len(nonce)} bytes"
+                    raise ValueError(f"record {i}: the CTR nonce should be {self._block_size} bytes, got {got}")
+            return self._ctr(records, ivs)
+
+        tag_size = self._tag_size if encrypt else -self._tag_size
+        lengths = np.fromiter((len(r) + tag_size for r in records), dtype=np.int64, count=len(records))
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        buf = bytearray(int(offsets[-1]) + self._block_size - 1)
+        out = memoryview(buf)
+        for record, iv, start in zip(records, ivs, offsets.tolist()):
+            cipher = Cipher(self.algorithm, self.mode(iv) if iv is not None else self.mode())
+            if encrypt:
+                context = cipher.encryptor()
+                written = context.update_into(record, out[start:])
+                written += _write(out, start + written, context.finalize())
+                if self._tag_size:
+                    _write(out, start + written, context.tag)
+            elif self._tag_size:
+                context = cipher.decryptor()
+                record = memoryview(record)
+                written = context.update_into(record[:len(record) - self._tag_size], out[start:])
+                _write(out, start + written, context.finalize_with_tag(bytes(record[len(record) - self._tag_size:])))
+            else:
+                context = cipher.decryptor()
+                written = context.update_into(record, out[start:])
+                _write(out, start + written, context.finalize())
+        out.release()
+        # drop the room update_into asked for
+        del buf[int(offsets[-1]):]
+        return buf, offsets
+
+    def _ctr(self, records: list[bytes], nonces: list[bytes]) -> tuple[bytearray, np.ndarray]:
+        """ The keystream of every record, a slot of whole blocks, is generated for all of them by a single ECB
+            call, then packed like the records
+        """
+        size = self._block_size
+        lengths = np.fromiter((len(r) for r in records), dtype=np.int64, count=len(records))
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        blocks = -(-lengths // size)
+        first_blocks = np.cumsum(blocks) - blocks
+
+        # the block index of every counter within its record
+        index = np.arange(int(blocks.sum()), dtype=np.uint64) - np.repeat(first_blocks, blocks).astype(np.uint64)
+        # big endian 128 bit integers, one per row
+        nonces = np.frombuffer(b"".join(nonces), dtype=">u8").reshape(-1, 2)
+        counters = np.empty((len(index), 2), dtype=">u8")
+        low = np.repeat(nonces[:, 1], blocks)
+        counters[:, 1] = low + index
+        # the carry of the (wrapping) lower halves
+        counters[:, 0] = np.repeat(nonces[:, 0], blocks) + (counters[:, 1] < low).astype(np.uint64)
+        keystream = np.frombuffer(self._ecb.update(counters.tobytes()), dtype=np.uint8)
+
+        pads = blocks * size - lengths
+        if pads.any():
+            # drop the keystream past the end of every record, the last pads[i] bytes of its slot
+            keep = np.ones(len(keystream), dtype=bool)
+            ends = np.repeat((first_blocks + blocks) * size, pads)
+            keep[ends - 1 - (np.arange(int(pads.sum())) - np.repeat(np.cumsum(pads) - pads, pads))] = False
+            keystream = keystream[keep]
+        out = bytearray(b"".join(records))
+        packed = np.frombuffer(out, dtype=np.uint8)
+        np.bitwise_xor(packed, keystream, out=packed)
+        return out, offsets
+
+
+def _write(out: memoryview, position: int, data: bytes) -> int:
+    out[position:position + len(data)] = data
+    return len(data)
+
+
+def _input_chunks(src: Union[BinaryIO, Iterable[bytes]], chunk_size: int, length: int = -1) -> Iterator[memoryview]:
+    """ length bytes (all of them if negative) of a file object or of an iterable of bytes-like objects, in views
+        of at most chunk_size bytes, the ones of a file read into a single reusable buffer
+    """
+    if hasattr(src, "readinto"):
+        buf = memoryview(bytearray(chunk_size))
+        while length and (read := src.readinto(buf[:chunk_size if length < 0 else min(chunk_size, length)])):
+            length -= read if length > 0 else 0
+            yield buf[:read]
+        return
+    for data in src:
+        data = memoryview(data).cast("B")
+        for start in range(0, len(data), chunk_size):
+            if not length:
+                return
+            chunk = data[start:start + chunk_size if length < 0 else start + min(chunk_size, length)]
+            length -= len(chunk) if length > 0 else 0
+            yield chunk
+
 
 class CustomMode(metaclass=ABCMeta):
     block_size = 16
-
-    def __init__(self):
-        self.black_box = self.BlackBox()
+    # whether the streamed messages are padded to whole blocks, only the block modes need it
+    padded = True
+    # blocks handled by a single ECB call, and by a single task of the pool
+    CHUNK_BLOCKS = 1 << 16
+
+    def __init__(self, workers: int = 1, executor: Type[Executor] = ThreadPoolExecutor, key: Optional[bytes] = None):
+        """ Args:
+                workers -- int -- size of the pool the independent chunks of blocks are spread over, no pool if 1
+                executor -- Type[Executor] -- pool implementation, the threads run in parallel as the ECB and XOR
+                    calls release the GIL, the processes are sent the key along with every chunk
+                key -- Optional[bytes] -- AES key, a random one if not given
+        """
+        self.black_box = self.BlackBox(key)
+        self.workers = workers
+        self.executor = executor
 
     class BlackBox:
-        def __init__(self):
-            self._cipher = Cipher(algorithms.AES(os.urandom(CBCMode.block_size)), modes.ECB())
+        """ AES in ECB mode, a single encryption and decryption context is kept for all the calls, ECB carries no
+            state from one block to the next as long as only whole blocks are passed """
+
+        def __init__(self, key: Optional[bytes] = None):
+            self.key = key or os.urandom(CustomMode.block_size)
+            cipher = Cipher(algorithms.AES(self.key), modes.ECB())
+            self._encryptor = cipher.encryptor()
+            self._decryptor = cipher.decryptor()
 
         def encrypt(self, data: bytes) -> bytes:
-            encryptor = self._cipher.encryptor()
-            return encryptor.update(data) + encryptor.finalize()
+            return self._encryptor.update(self._check(data))
 
         def decrypt(self, data: bytes) -> bytes:
-            encryptor = self._cipher.decryptor()
-            return encryptor.update(data) + encryptor.finalize()
+            return self._decryptor.update(self._check(data))
+
+        def encrypt_into(self, data: bytes, out: memoryview) -> int:
+            """ out must hold block_size - 1 bytes more than data
+                return the number of bytes written
+            """
+            return self._encryptor.update_into(self._check(data), out)
+
+        def decrypt_into(self, data: bytes, out: memoryview) -> int:
+            return self._decryptor.update_into(self._check(data), out)
+
+        @staticmethod
+        def _check(data: bytes) -> bytes:
+            if len(data) % CustomMode.block_size:
+                raise ValueError(f"the data should be a whole number of blocks, was {len(data)} bytes long")
+            return data
 
     def run(self, data: bytes, boo_boo: str):
-        encrypted_blocks = self._encrypt(data)
-        encrypted_blocks = BooBoo(encrypted_blocks).from_args(boo_boo)
-        decrypted_blocks = self._decrypt(b"".join(encrypted_blocks))
+        encrypted = self.encrypt(data)
+        if boo_boo != "none":
+            # the list of blocks is only needed to mess with them
+            encrypted = b"".join(BooBoo(self._blocks(encrypted)).from_args(boo_boo))
+        decrypted = self.decrypt(encrypted)
 
-        input_blocks = self._split(data)
+        input_blocks = self._blocks(data)
+        encrypted_blocks = self._blocks(encrypted)
+        decrypted_blocks = self._blocks(decrypted)
 
         # adjust the length of all lists to fit into zip()
         if len(decrypted_blocks) > len(input_blocks):
@@ -115,13 +406,13 @@ class CustomMode(metaclass=ABCMeta):
         block_n = 0
         for i, enc, dec in zip(input_blocks, encrypted_blocks, decrypted_blocks):
             try:
-                decoded_str = dec.decode('utf-8')
+                decoded_str = bytes(dec).decode('utf-8')
             except UnicodeDecodeError:
-                decoded_str = dec
+                decoded_str = bytes(dec)
             block_n += 1
             console.print(f"""BLOCK {block_n} 
-• IN:  [bold blue]'{i.decode('utf-8')}'[/bold blue]
-• ENC: [bold red]{enc.__str__().lstrip("b")}[/bold red]
+• IN:  [bold blue]'{bytes(i).decode('utf-8')}'[/bold blue]
+• ENC: [bold red]{bytes(enc).__str__().lstrip("b")}[/bold red]
 • DEC: [bold yellow]'{decoded_str}'[/bold yellow]
             """, style="bold green")
 
@@ -130,119 +421,335 @@ class CustomMode(metaclass=ABCMeta):
 ### BooBoo: {boo_boo}
 """))
 
-    @abstractmethod
-    def _encrypt(self, data: bytes) -> list[bytes]:
-        raise NotImplementedError("CustomMode must implement _encrypt method")
-
-    @abstractmethod
-    def _decrypt(self, data: bytes) -> list[bytes]:
-        raise NotImplementedError("CustomMode must implement _decrypt method")
+    def encrypt(self, data: bytes) -> memoryview:
+        """ Pad the last block if it is incomplete and encrypt everything in place of a copy of data
+            return a view of the ciphertext
+        """
+        buf, length = self._buffer(data, pad=True)
+        view = memoryview(buf)[:length]
+        self._encrypt_blocks(view, self._initial_state(self.start_block))
+        return view
+
+    def decrypt(self, enc: bytes) -> memoryview:
+        """ Decrypt everything and remove the padding of the last block
+            return a view of the message
+        """
+        enc = memoryview(enc)
+        buf = bytearray(len(enc) + self.block_size - 1)
+        view = memoryview(buf)
+        self._decrypt_blocks(enc, view, self._initial_state(self.start_block))
+        return view[:CMS.unpadded_length(view[:len(enc)], self.block_size)]
+
+    def encrypt_stream(self, src: BinaryIO, dst: BinaryIO, chunk_size: int = 0) -> int:
+        """ Encrypt everything left in src to dst a chunk at a time, the chaining state is carried from one chunk
+            to the next; the end of the stream of a block mode always gets a PKCS#7 padding, a whole block of it
+            when the stream ends on a block boundary, so that its removal is unambiguous, a stream mode is not padded
+            Args:
+                src -- BinaryIO -- plaintext
+                dst -- BinaryIO -- ciphertext, the IV or nonce is not written
+                chunk_size -- int -- bytes read at once, rounded to whole blocks, a chunk per worker by default
+            return the number of bytes written
+        """
+        chunk_size = self._stream_chunk_size(chunk_size)
+        view = memoryview(bytearray(chunk_size))
+        state = self._initial_state(self.start_block)
+        written = 0
+        while True:
+            read = _read_full(src, view)
+            length = read
+            if read < chunk_size and self.padded:
+                length += self.block_size - read % self.block_size
+                CMS.pad(view[:length], read)
+            state = self._encrypt_blocks(view[:length], state)
+            written += dst.write(view[:length])
+            if read < chunk_size:
+                return written
+
+    def decrypt_stream(self, src: BinaryIO, dst: BinaryIO, chunk_size: int = 0, start: Optional[bytes] = None) -> int:
+        """ Decrypt everything left in src to dst a chunk at a time, the last block is held back until the end of
+            src, when the padding of a block mode is removed; ValueError is raised if it is not a valid one
+            Args:
+                src -- BinaryIO -- ciphertext
+                dst -- BinaryIO -- plaintext
+                chunk_size -- int -- see encrypt_stream
+                start -- Optional[bytes] -- the IV or nonce the stream was encrypted with, the own one by default
+            return the number of bytes written
+        """
+        chunk_size = self._stream_chunk_size(chunk_size)
+        enc = memoryview(bytearray(chunk_size))
+        out = memoryview(bytearray(chunk_size + self.block_size - 1))
+        state = self._initial_state(start or self.start_block)
+        held = b""
+        written = 0
+        while read := _read_full(src, enc):
+            state = self._decrypt_blocks(enc[:read], out, state)
+            last = read - ((read - 1) % self.block_size + 1)
+            written += dst.write(held) + dst.write(out[:last])
+            held = bytes(out[last:read])
+        if self.padded:
+            held = held[:len(held) - CMS.padding_length(held, self.block_size)]
+        return written + dst.write(held)
+
+    def encrypt_file(self, src_path: str, dst_path: str, chunk_size: int = 0) -> int:
+        """ The IV or nonce is written as the first block of dst_path
+            return the number of bytes written
+        """
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            return dst.write(self.start_block) + self.encrypt_stream(src, dst, chunk_size)
+
+    def decrypt_file(self, src_path: str, dst_path: str, chunk_size: int = 0) -> int:
+        """ The message is decrypted to a temporary file next to dst_path, which replaces it only once the whole
+            file is decrypted, ValueError is raised for a block mode ciphertext which is not a whole number of blocks
+            or whose padding is not valid
+            return the number of bytes written
+        """
+        with open(src_path, "rb") as src:
+            start = src.read(self.block_size)
+            if len(start) < self.block_size:
+                raise ValueError(f"{src_path} is too short to hold the {self.name} IV or nonce")
+            fd, tmp_path = tempfile.mkstemp(dir=Path(dst_path).absolute().parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as dst:
+                    written = self.decrypt_stream(src, dst, chunk_size, start)
+                os.replace(tmp_path, dst_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            return written
 
     @property
     @abstractmethod
     def name(self):
         raise NotImplementedError("CustomMode must implement name property")
 
-    @staticmethod
-    def _xor(first: bytes, second: bytes) -> bytes:
-        if len(first) != len(second):
-            raise ValueError("to perform xor both bytes should be equal")
-        return bytes(b1 ^ b2 for b1, b2 in zip(first, second))
+    @property
+    @abstractmethod
+    def start_block(self) -> bytes:
+        """ The IV or the nonce """
+        raise NotImplementedError("CustomMode must implement start_block property")
 
-    def _split(self, s: bytes) -> list[bytes]:
-        return [s[k:k + self.block_size] for k in range(0, len(s), self.block_size)]
+    @abstractmethod
+    def _initial_state(self, start: bytes):
+        """ The chaining state before the first block, out of the IV or the nonce """
+        raise NotImplementedError("CustomMode must implement _initial_state method")
+
+    @abstractmethod
+    def _encrypt_blocks(self, data: memoryview, state):
+        """ Encrypt the whole blocks of data in place
+            return the chaining state after the last of them
+        """
+        raise NotImplementedError("CustomMode must implement _encrypt_blocks method")
+
+    @abstractmethod
+    def _decrypt_blocks(self, enc: memoryview, out: memoryview, state):
+        """ Decrypt enc to out, which holds block_size - 1 bytes more than enc
+            return the chaining state after the last block
+        """
+        raise NotImplementedError("CustomMode must implement _decrypt_blocks method")
+
+    def _buffer(self, data: bytes, pad: bool = False) -> tuple[bytearray, int]:
+        """ The output buffer of a message, data copied at its start, followed by the CMS padding of an incomplete
+            last block if pad, and by the block_size - 1 bytes the ECB context asks for on top of its input
+            return the buffer and the length of the (padded) message in it
+        """
+        length = len(data)
+        if pad and length % self.block_size:
+            length += self.block_size - length % self.block_size
+        buf = bytearray(length + self.block_size - 1)
+        buf[:len(data)] = data
+        CMS.pad(memoryview(buf)[:length], len(data))
+        return buf, length
+
+    def _stream_chunk_size(self, chunk_size: int) -> int:
+        chunk_size = chunk_size or max(1, self.workers) * self.CHUNK_BLOCKS * self.block_size
+        return max(self.block_size, chunk_size - chunk_size % self.block_size)
+
+    def _in_parallel(self, length: int) -> bool:
+        return self.workers > 1 and length > self.CHUNK_BLOCKS * self.block_size
+
+    def _chunks(self, data: memoryview) -> Iterator[tuple[int, memoryview]]:
+        """ The start and the data of every chunk, copied for the processes, which cannot be sent views """
+        chunk = self.CHUNK_BLOCKS * self.block_size
+        for start in range(0, len(data), chunk):
+            view = data[start:start + chunk]
+            yield start, bytes(view) if issubclass(self.executor, ProcessPoolExecutor) else view
+
+    def _map_into(self, fn: Callable, tasks: Iterator[tuple], out: memoryview):
+        """ Run fn over the tasks in the pool, the results are stitched back one after the other in out """
+        position = 0
+        for result in ordered_map(fn, tasks, self.workers, executor=self.executor):
+            out[position:position + len(result)] = result
+            position += len(result)
+
+    def _blocks(self, s: bytes) -> list[memoryview]:
+        view = memoryview(s)
+        return [view[k:k + self.block_size] for k in range(0, len(view), self.block_size)]
 
 
 class CBCMode(CustomMode):
     name = "CBC"
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, workers: int = 1, executor: Type[Executor] = ThreadPoolExecutor, key: Optional[bytes] = None):
+        super().__init__(workers, executor, key)
         self.iv = os.urandom(self.block_size)
 
-    def _encrypt(self, data: bytes) -> list[bytes]:
-        blocks = self._split(data)
-
-        encrypted: list[bytes] = []
-        previous_result = self.iv
-
-        for i, block in enumerate(blocks):
-            try:
-                block = CMS.add_padding(block, self.block_size)
-                previous_result = self.black_box.encrypt(self._xor(previous_result, block))
-                encrypted.append(previous_result)
-            except ValueError as e:
-                console.log(f"Skipping block NR {i} during encryption due to exception: {e}")
-                encrypted.append(b"FAILED BLOCK")
-
-        return encrypted
-
-    def _decrypt(self, enc: bytes) -> list[bytes]:
-        blocks = self._split(enc)
-
-        decrypted: list[bytes] = []
-        previous_block = self.iv
-
-        for i, block in enumerate(blocks):
-            try:
-                dec_block = self._xor(previous_block, self.black_box.decrypt(block))
-                dec_block = CMS.rm_padding(dec_block, self.block_size)
-            except ValueError as e:
-                console.log(f"Skipping block NR {i} during decryption due to exception: {e}")
-                dec_block = b"FAILED BLOCK"
-            decrypted.append(dec_block)
-            previous_block = block
-
-        return decrypted
+    @property
+    def start_block(self) -> bytes:
+        return self.iv
+
+    def decrypt(self, enc: bytes) -> memoryview:
+        """ The incomplete last block left by a damaged ciphertext is skipped, see CustomMode.decrypt """
+        tail = len(enc) % self.block_size
+        if tail:
+            console.log(f"Skipping the incomplete last block of {tail} bytes during decryption")
+        return super().decrypt(memoryview(enc)[:len(enc) - tail])
+
+    def _initial_state(self, start: bytes) -> bytes:
+        # the previous ciphertext block
+        return start
+
+    def _encrypt_blocks(self, data: memoryview, previous: bytes) -> bytes:
+        """ Every block depends on the previous ciphertext block, the blocks are XORed as 128 bit integers and
+            encrypted one by one
+        """
+        previous = int.from_bytes(previous, "big")
+        for i in range(0, len(data), self.block_size):
+            block = (int.from_bytes(data[i:i + self.block_size], "big") ^ previous).to_bytes(self.block_size, "big")
+            encrypted = self.black_box.encrypt(block)
+            data[i:i + self.block_size] = encrypted
+            previous = int.from_bytes(encrypted, "big")
+        return previous.to_bytes(self.block_size, "big")
+
+    def _decrypt_blocks(self, enc: memoryview, out: memoryview, previous: bytes) -> bytes:
+        """ The blocks are decrypted by a single ECB call, then XORed with the ciphertext shifted by a block at once;
+            in parallel, every chunk only needs the last ciphertext block of the previous one
+        """
+        if self._in_parallel(len(enc)):
+            tasks = ((self.black_box.key, bytes(enc[start - self.block_size:start]) if start else previous, chunk)
+                     for start, chunk in self._chunks(enc))
+            self._map_into(_cbc_decrypt_chunk, tasks, out)
+        else:
+            _cbc_decrypt_into(self.black_box, previous, enc, out)
+        return bytes(enc[len(enc) - self.block_size:]) if enc else previous
 
 
 class CTRMode(CustomMode):
     name = "CTR"
+    padded = False
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, workers: int = 1, executor: Type[Executor] = ThreadPoolExecutor, key: Optional[bytes] = None):
+        super().__init__(workers, executor, key)
         self.nonce = os.urandom(self.block_size)
 
-    def _encrypt(self, data: bytes) -> list[bytes]:
-        blocks = self._split(data)
-
-        encrypted: list[bytes] = []
-        nonce_int = int.from_bytes(self.nonce, "big")
-
-        for i, block in enumerate(blocks):
-            try:
-                i_nonce = (nonce_int + i).to_bytes(len(self.nonce), "big")
-                i_nonce = self.black_box.encrypt(i_nonce)
-                block = CMS.add_padding(block, self.block_size)
-                i_enc = self._xor(block, i_nonce)
-            except ValueError as e:
-                console.log(f"Skipping block NR {i} during encryption due to exception: {e}")
-                i_enc = b"FAILED BLOCK"
-            encrypted.append(i_enc)
-
-        return encrypted
-
-    def _decrypt(self, enc: bytes) -> list[bytes]:
-        blocks = self._split(enc)
-
-        decrypted: list[bytes] = []
-        nonce_int = int.from_bytes(self.nonce, "big")
-
-        for i, block in enumerate(blocks):
-            try:
-                i_nonce = (nonce_int + i).to_bytes(len(self.nonce), "big")
-                i_nonce = self.black_box.encrypt(i_nonce)
-                i_dec = self._xor(block, i_nonce)
-                i_dec = CMS.rm_padding(i_dec, self.block_size)
-            except ValueError as e:
-                console.log(f"Skipping block NR {i} during decryption due to exception: {e}")
-                i_dec = b"FAILED BLOCK"
-            decrypted.append(i_dec)
-
-        return decrypted
+    @property
+    def start_block(self) -> bytes:
+        return self.nonce
+
+    def _initial_state(self, start: bytes) -> int:
+        # the counter block of the next block
+        return int.from_bytes(start, "big")
+
+    def _encrypt_blocks(self, data: memoryview, counter: int) -> int:
+        self._apply_keystream(data, counter)
+        return counter + -(-len(data) // self.block_size)
+
+    def _decrypt_blocks(self, enc: memoryview, out: memoryview, counter: int) -> int:
+        out[:len(enc)] = enc
+        return self._encrypt_blocks(out[:len(enc)], counter)
+
+    def _apply_keystream(self, data: memoryview, counter: int):
+        """ XOR data with the keystream in place, a chunk of CHUNK_BLOCKS blocks at a time, every chunk starting
+            from its own counter, the chunks are spread over the pool if there is one
+        """
+        if self._in_parallel(len(data)):
+            tasks = ((self.black_box.key, counter + start // self.block_size, chunk)
+                     for start, chunk in self._chunks(data))
+            self._map_into(_ctr_chunk, tasks, data)
+            return
+
+        chunk = self.CHUNK_BLOCKS * self.block_size
+        blocks = min(self.CHUNK_BLOCKS, -(-len(data) // self.block_size))
+        counters = np.empty((blocks, 2), dtype=">u8")
+        keystream = bytearray(blocks * self.block_size + self.block_size - 1)
+        for start in range(0, len(data), chunk):
+            _ctr_xor_into(self.black_box, counter + start // self.block_size, data[start:start + chunk], counters,
+                          keystream)
+
+
+def _read_full(src: BinaryIO, buf: memoryview) -> int:
+    """ Fill buf from src, short only at the end of src
+        return the number of bytes read
+    """
+    read = 0
+    while read < len(buf) and (n := src.readinto(buf[read:])):
+        read += n
+    return read
+
+
+def _ctr_xor_into(black_box: CustomMode.BlackBox, counter: int, data: memoryview, counters: np.ndarray,
+                  keystream: bytearray):
+    """ XOR data in place with the keystream starting at the counter block (mod 2^128), counters and keystream
+        are reusable scratch buffers large enough for the data
+    """
+    count = -(-len(data) // CustomMode.block_size)
+    high, low = divmod(counter % (1 << 128), 1 << 64)
+    lows = np.arange(count, dtype=np.uint64) + np.uint64(low)
+    # big endian 128 bit integers, one per row
+    counters[:count, 1] = lows
+    # the carry of the (wrapping) lower halves
+    counters[:count, 0] = np.uint64(high) + (lows < np.uint64(low)).astype(np.uint64)
+    black_box.encrypt_into(counters[:count].data.cast("B"), memoryview(keystream))
+    _xor_into(data, memoryview(keystream)[:len(data)])
+
+
+def _ctr_chunk(args: tuple[bytes, int, bytes]) -> bytes:
+    """ Task of the pool: the chunk XORed with the keystream
+        Args:
+            args -- tuple -- the key, the counter block of the first block of the chunk and the chunk
+        return the transformed chunk
+    """
+    key, counter, data = args
+    data = bytearray(data)
+    blocks = -(-len(data) // CustomMode.block_size)
+    _ctr_xor_into(CustomMode.BlackBox(key), counter, memoryview(data), np.empty((blocks, 2), dtype=">u8"),
+                  bytearray(blocks * CustomMode.block_size + CustomMode.block_size - 1))
+    return data
+
+
+def _cbc_decrypt_into(black_box: CustomMode.BlackBox, previous: bytes, enc: memoryview, out: memoryview):
+    """ Decrypt the whole blocks of enc to out, previous being the ciphertext block preceding them (or the IV);
+        out must hold block_size - 1 bytes more than enc
+    """
+    size = CustomMode.block_size
+    black_box.decrypt_into(enc, out)
+    if enc:
+        _xor_into(out[:size], previous)
+        _xor_into(out[size:len(enc)], enc[:len(enc) - size])
+
+
+def _cbc_decrypt_chunk(args: tuple[bytes, bytes, bytes]) -> bytes:
+    """ Task of the pool: the decrypted chunk
+        Args:
+            args -- tuple -- the key, the ciphertext block preceding the chunk (or the IV) and the chunk
+        return the decrypted chunk, still padded
+    """
+    key, previous, enc = args
+    out = bytearray(len(enc) + CustomMode.block_size - 1)
+    _cbc_decrypt_into(CustomMode.BlackBox(key), previous, memoryview(enc), memoryview(out))
+    del out[len(enc):]
+    return out
+
+
+def _xor_into(target: memoryview, other: bytes):
+    """ target ^= other, byte by byte, both as long as each other """
+    target = np.frombuffer(target, dtype=np.uint8)
+    np.bitwise_xor(target, np.frombuffer(other, dtype=np.uint8), out=target)
 
 
 class CMS:
+    """ Padding with bytes of the value of its length: of an incomplete last block for the in-memory messages, of
+        every streamed message of a block mode (PKCS#7)
+    """
 
     @staticmethod
     def add_padding(block: bytes, block_size: int) -> bytes:
@@ -253,13 +760,39 @@ class CMS:
 
     @staticmethod
     def rm_padding(block: bytes, block_size: int) -> bytes:
-        last_byte = block[len(block) - 1]
+        return block[:CMS.unpadded_length(block, block_size)]
+
+    @staticmethod
+    def pad(buf: memoryview, length: int):
+        """ Pad the message of the given length at the start of buf up to the end of buf, in place """
+        diff = len(buf) - length
+        buf[length:] = diff * bytes([diff])
+
+    @staticmethod
+    def padding_length(data: bytes, block_size: int) -> int:
+        """ The length of the padding data ends with, data being padded whatever its length (PKCS#7)
+            ValueError is raised if its end is not a valid padding
+        """
+        last_byte = data[len(data) - 1] if data else 0
+        if not 0 < last_byte <= min(block_size, len(data)) or \
+                bytes(data[len(data) - last_byte:]) != last_byte * bytes([last_byte]):
+            raise ValueError("invalid padding, the ciphertext is damaged or was encrypted with another key")
+        return last_byte
+
+    @staticmethod
+    def unpadded_length(data: bytes, block_size: int) -> int:
+        """ The length of data once the padding is removed from its last block, data is left as it is when its
+            end does not look like a padding
+        """
+        if not data:
+            return 0
+        last_byte = data[len(data) - 1]
         if last_byte <= block_size:
             ctr = 0
-            for b in block[::-1]:
+            for b in bytes(data[-block_size:])[::-1]:
                 if b != last_byte or ctr >= last_byte:
                     break
                 ctr += 1
             if ctr == last_byte:
-                block = block[:len(block) - last_byte]
-        return block
+                return len(data) - last_byte
+        return len(data)
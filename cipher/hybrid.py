@@ -0,0 +1,79 @@
+import os
+import struct
+import tempfile
+from pathlib import Path
+
+from cryptography.hazmat.primitives.ciphers import modes, algorithms
+
+from cipher.asymmetric import RSASimple
+from cipher.block import BlockCipher
+
+MAGIC = b"RSAH"
+VERSION = 1
+# magic, version, length of the wrapped key
+_HEADER = struct.Struct(">4sBH")
+KEY_SIZE = 32
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+class HybridCipher:
+    """ RSA wraps a random AES-256 key, the payload itself is encrypted with AES-GCM in a single streaming pass
+
+        Container layout:
+            header -- magic "RSAH", version (1 byte), length of the wrapped key (2 bytes, big endian)
+            wrapped key -- the AES key encrypted with the public RSA key
+            nonce -- 12 bytes
+            ciphertext -- as long as the payload
+            tag -- 16 bytes, the GCM tag, written last once the whole payload is encrypted
+    """
+
+    def __init__(self, rsa: RSASimple, chunk_size: int = BlockCipher.CHUNK_SIZE):
+        self.rsa = rsa
+        self.chunk_size = chunk_size
+
+    def encrypt_file(self, src_path: str, dst_path: str, preset: dict = None) -> int:
+        """ return the number of bytes written """
+        key = os.urandom(KEY_SIZE)
+        nonce = os.urandom(NONCE_SIZE)
+        wrapped = self.rsa.encrypt(key, "e", preset)
+        cipher = BlockCipher(algorithms.AES(key), modes.GCM(nonce), b"")
+
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            written = dst.write(_HEADER.pack(MAGIC, VERSION, len(wrapped)) + wrapped + nonce)
+            written += cipher.encrypt_stream(src, dst, self.chunk_size)
+            return written + dst.write(cipher.tag)
+
+    def decrypt_file(self, src_path: str, dst_path: str, preset: dict = None) -> int:
+        """ The payload is decrypted to a temporary file next to dst_path which replaces it only once the tag is
+            verified, InvalidTag (or ValueError for a malformed container or a wrong key) is raised otherwise
+            return the number of bytes written
+        """
+        with open(src_path, "rb") as src:
+            magic, version, wrapped_length = _HEADER.unpack(src.read(_HEADER.size).ljust(_HEADER.size, b"\x00"))
+            if magic != MAGIC:
+                raise ValueError(f"not a hybrid RSA container: {src_path}")
+            if version != VERSION:
+                raise ValueError(f"unsupported hybrid RSA container version: {version}")
+            wrapped = src.read(wrapped_length)
+            nonce = src.read(NONCE_SIZE)
+            body = src.tell()
+            length = os.fstat(src.fileno()).st_size - body - TAG_SIZE
+            if length < 0:
+                raise ValueError(f"truncated hybrid RSA container: {src_path}")
+            src.seek(body + length)
+            tag = src.read(TAG_SIZE)
+            src.seek(body)
+
+            cipher = BlockCipher(algorithms.AES(self.rsa.decrypt(wrapped, "d", preset)), modes.GCM(nonce), b"")
+            cipher.tag = tag
+
+            fd, tmp_path = tempfile.mkstemp(dir=Path(dst_path).absolute().parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as dst:
+                    written = cipher.decrypt_stream(src, dst, length, self.chunk_size)
+                os.replace(tmp_path, dst_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            return written
@@ -1,5 +1,13 @@
-from typing import Optional
+from math import lcm
+from pathlib import Path
+from typing import Callable, Iterator, Optional
 
+from bitarray import bitarray
+from bitarray.util import int2ba
+
+from generators.sequence import SequenceHeader, SequenceWriter
+from utils.blum import read_blum_key
+from utils.parallel import ordered_map
 from utils.prime import generate_coprime_random_integer
 
 from rich.console import Console
@@ -9,30 +17,126 @@ console = Console()
 
 
 class BBS:
+    # number of bits yielded at once by the stream, 32 KiB worth of a sequence
+    CHUNK_BITS = 8 * 32768
+
+    def __init__(self, n: int, seed: int, bits_per_step: int = 1, factors: Optional[tuple[int, int]] = None):
+        if not 1 <= bits_per_step <= self.max_bits_per_step(n):
+            raise ValueError(f"bits per step must be in range [1, {self.max_bits_per_step(n)}] for the given modulus"
+                             f", was: {bits_per_step}")
+        self.n = n
+        self.seed = seed
+        self.bits_per_step = bits_per_step
+        # λ(n) = lcm(p - 1, q - 1) is only known with the factorization, it enables the jump-ahead
+        self.carmichael = lcm(factors[0] - 1, factors[1] - 1) if factors else None
 
     @staticmethod
-    def new(seq_len: int) -> Optional[str]:
+    def max_bits_per_step(n: int) -> int:
+        """ Number of the least significant bits which can be safely extracted from each x_i: log2(log2 n) """
+        return max(1, n.bit_length().bit_length() - 1)
+
+    def x_at(self, i: int) -> int:
+        """ Compute x_i, directly as x_0^(2^i mod λ(n)) mod n if the factors are known """
+        x_0 = self.seed ** 2 % self.n
+        if self.carmichael:
+            return pow(x_0, pow(2, i, self.carmichael), self.n)
+        x_i = x_0
+        for _ in range(i):
+            x_i = x_i * x_i % self.n
+        return x_i
+
+    def stream(self, seq_len: int, offset: int = 0, workers: int = 1,
+               chunk_bits: int = CHUNK_BITS) -> Iterator[bitarray]:
+        """ Yield the sequence starting at the offset bit in chunks of at most chunk_bits bits,
+            the memory usage does not depend on seq_len.
+            With workers > 1 the chunks are generated as independent shards in a process pool,
+            which requires the factorization of n.
+        """
+        k = self.bits_per_step
+        first_step, skip = offset // k + 1, offset % k
+        last_step = first_step + -(-(skip + seq_len) // k)
+        steps_per_chunk = max(1, chunk_bits // k)
+        shards = ((s, min(steps_per_chunk, last_step - s)) for s in range(first_step, last_step, steps_per_chunk))
+
+        if workers > 1 and self.carmichael:
+            x_0 = self.seed ** 2 % self.n
+            chunks = ordered_map(_shard, ((self.n, x_0, self.carmichael, k, s, steps) for s, steps in shards), workers)
+        else:
+            if workers > 1:
+                console.print("[yellow]Factors of the Blum integer are unknown, generating on a single core[/yellow]")
+            chunks = self._sequential(shards)
+
+        remaining = seq_len
+        for chunk in chunks:
+            if skip:
+                del chunk[:skip]
+                skip = 0
+            del chunk[remaining:]
+            remaining -= len(chunk)
+            yield chunk
+
+    def _sequential(self, shards: Iterator[tuple[int, int]]) -> Iterator[bitarray]:
+        x_i = None
+        for first_step, steps in shards:
+            if x_i is None:
+                x_i = self.x_at(first_step - 1)
+            chunk, x_i = _squarings(self.n, x_i, self.bits_per_step, steps)
+            yield chunk
+
+    @staticmethod
+    def read_blum_integer(required: bool = True) -> Optional[int]:
+        """ Current blum integer, None if it was not generated yet (reported unless not required) """
         try:
             with open("numbers/blum.integer") as f:
-                blum_int = int(f.read())
+                return int(f.read())
         except FileNotFoundError:
+            if not required:
+                return None
             console.print(f"[bold red]Generate the blum integer first![/bold red]")
             console.print(
                 Markdown(f"Run this command first: `./run.py generate-blum-int -p <P_PRIME_LEN> -q <Q_PRIME_LEN>`"))
             return None
 
-        random_natural_coprime_to_blum_int = generate_coprime_random_integer(blum_int)
+    @staticmethod
+    def new(seq_len: int, path: Path, bits_per_step: int = 1, offset: int = 0, workers: int = 1,
+            seed: Optional[int] = None, observer: Optional[Callable[[bitarray], None]] = None) -> Optional[Path]:
+        """ Generate a new sequence into path, observer (e.g. an online test) is given every chunk on the way """
+        blum_int = BBS.read_blum_integer()
+        if blum_int is None:
+            return None
+
+        if seed is None:
+            seed = generate_coprime_random_integer(blum_int)
+        bbs = BBS(blum_int, seed, bits_per_step, read_blum_key(blum_int))
+
+        with SequenceWriter(path, SequenceHeader(bits_per_step=bits_per_step, offset=offset, n=blum_int)) as writer:
+            for chunk in bbs.stream(seq_len, offset, workers):
+                writer.write(chunk)
+                if observer:
+                    observer(chunk)
+
+        console.print(f"[bold magenta]Generated sequence[/bold magenta]: {seq_len} bits from offset {offset} "
+                      f"({bits_per_step} per squaring) written to {path}")
+        console.print(f"[bold magenta]Seed[/bold magenta]: {seed}")
+
+        return path
 
-        n, a, r = blum_int, random_natural_coprime_to_blum_int, seq_len
 
-        sequence = ""
-        x_0 = a ** 2 % n
-        x_i_previous = x_0
-        for i in range(1, r + 1):
-            x_i = x_i_previous ** 2 % n
-            sequence += str(0 if x_i % 2 == 0 else 1)
-            x_i_previous = x_i
+def _squarings(n: int, x: int, k: int, steps: int) -> tuple[bitarray, int]:
+    """ Square x the given number of times, collecting the k least significant bits of each result """
+    mask = (1 << k) - 1
+    chunk = bitarray()
+    for _ in range(steps):
+        x = x * x % n
+        if k == 1:
+            chunk.append(x & 1)
+        else:
+            chunk.extend(int2ba(x & mask, k))
+    return chunk, x
 
-        console.print(f"[bold magenta]Generated sequence[/bold magenta]: {sequence}")
 
-        return sequence
+def _shard(args: tuple[int, int, int, int, int, int]) -> bitarray:
+    """ Generate steps squarings starting at first_step, jumping ahead to x_(first_step - 1) on its own """
+    n, x_0, carmichael, k, first_step, steps = args
+    x = pow(x_0, pow(2, first_step - 1, carmichael), n)
+    return _squarings(n, x, k, steps)[0]
@@ -0,0 +1,200 @@
+import hashlib
+import mmap
+import struct
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from bitarray import bitarray
+
+MAGIC = b"BBS\x00"
+VERSION = 1
+
+# magic, version, bits per step, modulus bit length, sequence length in bits, offset of the first bit,
+# modulus fingerprint; padded so that the packed bits start at a 64 byte boundary
+_HEADER = struct.Struct(">4sBBHQQ16s24x")
+HEADER_SIZE = _HEADER.size
+
+
+def fingerprint(n: int) -> bytes:
+    """ Short, non secret identifier of the modulus the sequence was generated with """
+    return hashlib.sha256(n.to_bytes((n.bit_length() + 7) // 8, "big")).digest()[:16]
+
+
+class SequenceHeader:
+
+    def __init__(self, length: int = 0, bits_per_step: int = 0, offset: int = 0, n: Optional[int] = None,
+                 modulus_bits: int = 0, modulus_fingerprint: bytes = bytes(16)):
+        self.length = length
+        self.bits_per_step = bits_per_step
+        self.offset = offset
+        self.modulus_bits = n.bit_length() if n else modulus_bits
+        self.modulus_fingerprint = fingerprint(n) if n else modulus_fingerprint
+
+    def pack(self) -> bytes:
+        return _HEADER.pack(MAGIC, VERSION, self.bits_per_step, self.modulus_bits, self.length, self.offset,
+                            self.modulus_fingerprint)
+
+    @staticmethod
+    def unpack(data: bytes) -> "SequenceHeader":
+        magic, version, bits_per_step, modulus_bits, length, offset, modulus_fingerprint = _HEADER.unpack(data)
+        if magic != MAGIC:
+            raise ValueError("not a binary BBS sequence file")
+        if version != VERSION:
+            raise ValueError(f"unsupported BBS sequence file version: {version}")
+        return SequenceHeader(length, bits_per_step, offset, modulus_bits=modulus_bits,
+                              modulus_fingerprint=modulus_fingerprint)
+
+    def matches(self, n: int) -> bool:
+        return self.modulus_fingerprint == fingerprint(n)
+
+    def check_modulus(self, n: Optional[int]):
+        """ Raise if the sequence was generated under another modulus than n
+            Args:
+                n -- Optional[int] -- current blum integer, nothing is checked if it is unknown
+            Sequences converted from the text format do not record their modulus and always pass
+        """
+        if n is None or self.modulus_fingerprint == bytes(16):
+            return
+        if not self.matches(n):
+            raise ValueError("the sequence was not generated with the blum integer in numbers/blum.integer, "
+                             "regenerate it or restore the matching blum integer")
+
+
+class SequenceWriter:
+    """ Write a sequence chunk by chunk as packed bits, the length in the header is filled in on close """
+
+    def __init__(self, path: Union[str, Path], header: SequenceHeader):
+        self.header = header
+        self.header.length = 0
+        self._pending = bitarray(endian="big")
+        self._f = open(path, "wb")
+        self._f.write(self.header.pack())
+
+    def write(self, bits: bitarray):
+        self.header.length += len(bits)
+        if not self._pending and len(bits) % 8 == 0:
+            self._f.write(bits.tobytes())
+            return
+        self._pending.extend(bits)
+        aligned = len(self._pending) - len(self._pending) % 8
+        if aligned:
+            self._f.write(self._pending[:aligned].tobytes())
+            del self._pending[:aligned]
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self._pending:
+            self._f.write(self._pending.tobytes())
+        self._f.seek(0)
+        self._f.write(self.header.pack())
+        self._f.close()
+
+    def __enter__(self) -> "SequenceWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Sequence:
+    header: SequenceHeader
+    _bits: bitarray
+
+    def __len__(self) -> int:
+        return self.header.length
+
+    def __getitem__(self, key: slice) -> bitarray:
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError("only contiguous ranges of a sequence can be read")
+        return self.bits(start, stop)
+
+    def bits(self, start: int = 0, stop: Optional[int] = None) -> bitarray:
+        """ Copy of the [start, stop) range of the sequence, only that range is read """
+        stop = len(self) if stop is None else min(stop, len(self))
+        return self._bits[start:stop]
+
+    def view(self) -> bitarray:
+        """ The whole sequence, without a copy when its length is a whole number of bytes
+            A trailing partial byte cannot be expressed by a buffer backed bitarray, the sequence is copied then
+        """
+        if len(self._bits) == len(self):
+            return self._bits
+        return self.bits()
+
+    def chunks(self, chunk_bits: int = 8 * 32768) -> Iterator[bitarray]:
+        for start in range(0, len(self), chunk_bits):
+            yield self.bits(start, start + chunk_bits)
+
+    def close(self):
+        """ Release what backs the sequence, its bits cannot be read afterwards """
+
+    def __enter__(self) -> "Sequence":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SequenceFile(Sequence):
+    """ Read-only, memory-mapped view over a sequence, the bits are sliced straight from the page cache """
+
+    def __init__(self, path: Union[str, Path]):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = SequenceHeader.unpack(self._mm[:HEADER_SIZE])
+        self._payload = memoryview(self._mm)[HEADER_SIZE:HEADER_SIZE + (self.header.length + 7) // 8]
+        # buffer backed bitarray, no copy of the file contents is made
+        self._bits = bitarray(buffer=self._payload, endian="big")
+
+    def close(self):
+        """ Unmap the file, BufferError is raised while a view() of it is still referenced """
+        if self._mm.closed:
+            return
+        # the mapping cannot be closed while its buffer is exported
+        self._bits = bitarray(endian="big")
+        self._payload.release()
+        self._mm.close()
+
+
+class LegacySequence(Sequence):
+    """ Sequence stored as '0'/'1' text, parsed as a whole on load """
+
+    def __init__(self, path: Union[str, Path]):
+        with open(path, "r") as f:
+            self._bits = bitarray(f.read().strip(), endian="big")
+        self.header = SequenceHeader(len(self._bits))
+
+
+def is_binary(path: Union[str, Path]) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def open_sequence(path: Union[str, Path], n: Optional[int] = None) -> Sequence:
+    """ Open a binary or legacy text sequence
+        Args:
+            path -- Union[str, Path] -- sequence file
+            n -- Optional[int] -- blum integer the sequence is expected to come from, checked against the header
+        return Sequence
+    """
+    if not path:
+        raise ValueError("provide file path to BBS sequence with -f")
+    sequence = SequenceFile(path) if is_binary(path) else LegacySequence(path)
+    sequence.header.check_modulus(n)
+    return sequence
+
+
+def text_to_binary(src: Union[str, Path], dst: Union[str, Path], chunk_size: int = 1 << 20):
+    """ Convert the legacy '0'/'1' text format, the generator parameters are unknown and left empty """
+    with open(src, "r") as f, SequenceWriter(dst, SequenceHeader()) as writer:
+        while chunk := f.read(chunk_size):
+            writer.write(bitarray(chunk.strip(), endian="big"))
+
+
+def binary_to_text(src: Union[str, Path], dst: Union[str, Path]):
+    with open(dst, "w") as f:
+        with SequenceFile(src) as sequence:
+            for chunk in sequence.chunks():
+                f.write(chunk.to01())
@@ -1,37 +1,125 @@
+import math
 import os
 import time
 from abc import ABCMeta, abstractmethod
-from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from statistics import mean
+from typing import Any, Callable, Optional
 
-from cryptography.hazmat.primitives.ciphers import algorithms, modes
+import numpy as np
+from cryptography.exceptions import UnsupportedAlgorithm
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from pandas import DataFrame
-import pandas as pd
 
-from cipher.block import BlockCipher
+from cipher.asymmetric import RSASimple
+from cipher.block import BatchCipher, BlockCipher, CBCMode, CMS, CTRMode, CustomMode
+from tests.config import ConfigBench
 
 
-class Benchmark(metaclass=ABCMeta):
-    benchmarks: list["bench_result"] = []
+class BenchResults:
+    """ Columnar collector of the measurements of a benchmark run, a list per column, a single DataFrame is only
+        built at the end
+    """
+
+    def __init__(self):
+        self.columns: dict[str, list] = {}
+        self.rows = 0
+
+    def add(self, row: dict):
+        for key in row:
+            if key not in self.columns:
+                # a column first seen now is empty in the previous rows
+                self.columns[key] = [None] * self.rows
+        for key, column in self.columns.items():
+            column.append(row.get(key))
+        self.rows += 1
+
+    def frame(self) -> DataFrame:
+        return DataFrame(self.columns)
 
-    bench_result = namedtuple("BenchResult", ["details", "result"])
 
-    def __init__(self, path: Path, num_iter: int):
-        self.num_iter = num_iter
+class Benchmark(metaclass=ABCMeta):
+    """ Every measurement is warmed up, calibrated to a number of calls per sample lasting at least min_time, then
+        sampled repeat times; the setup of every sample is timed apart from the operation itself
+    """
+    WARMUP = ConfigBench.WARMUP
+    REPEAT = ConfigBench.REPEAT
+    MIN_TIME = ConfigBench.MIN_TIME
+
+    def __init__(self, path: Path, repeat: Optional[int] = None, warmup: Optional[int] = None,
+                 min_time: Optional[float] = None):
         self.filename = path.name
+        self.repeat = max(1, repeat or self.REPEAT)
+        self.warmup = self.WARMUP if warmup is None else warmup
+        self.min_time = self.MIN_TIME if min_time is None else min_time
+        self.results = BenchResults()
+
+    def measure(self, details: dict, operation: Callable[[Any], Any], setup: Callable[[], Any] = lambda: None,
+                size: int = 0):
+        """ Time operation(setup()) repeat times over a calibrated number of calls
+            Args:
+                details -- dict -- columns describing the measurement
+                operation -- Callable[[Any], Any] -- the timed operation, given what setup returned
+                setup -- Callable[[], Any] -- run before every sample, timed apart
+                size -- int -- bytes processed by a call, for the throughput
+            median, mean, std and the throughput are taken over the samples, each one timing its calls as a single
+            batch; "call p95" and "call p99" over the same number of calls timed one by one after every sample, left
+            empty (NaN) when too few calls were timed to estimate them
+        """
+        state = setup()
+        for _ in range(self.warmup):
+            operation(state)
+        number = self._calibrate(operation, state)
 
-    def timeit(self, details: dict, duration: float):
-        self.benchmarks.append(self.bench_result(
-            details=details,
-            result=duration))
+        samples, setups, calls = [], [], []
+        for _ in range(self.repeat):
+            start_setup = time.perf_counter()
+            state = setup()
+            end_setup = time.perf_counter()
+
+            start = time.perf_counter()
+            for _ in range(number):
+                operation(state)
+            end = time.perf_counter()
+
+            # the tail needs every call on its own, timed apart so that the reads of the clock stay out of the sample
+            for _ in range(number):
+                start_call = time.perf_counter()
+                operation(state)
+                calls.append(time.perf_counter() - start_call)
+
+            setups.append(end_setup - start_setup)
+            samples.append((end - start) / number)
+
+        samples = np.array(samples)
+        median = float(np.median(samples))
+        self.results.add(details | {
+            "median": median,
+            "mean": float(samples.mean()),
+            "std": float(samples.std()),
+            "call p95": _tail(calls, 95),
+            "call p99": _tail(calls, 99),
+            "setup": float(np.median(setups)),
+            "calls": number,
+            "MB/s": size / median / 1e6 if size and median else float("nan"),
+            "file": self.filename,
+        })
+
+    def _calibrate(self, operation: Callable[[Any], Any], state) -> int:
+        """ The number of calls lasting at least min_time, grown from a single one """
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                operation(state)
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.min_time:
+                return number
+            # aim a bit past min_time, at least doubling so that the loop ends quickly
+            number = max(2 * number, math.ceil(number * 1.2 * self.min_time / elapsed) if elapsed else 0)
 
     def summarize(self) -> DataFrame:
-        frames: list[DataFrame] = []
-        for b in self.benchmarks:
-            frames.append(DataFrame.from_dict({k: [v] for k, v in b.details.items()} |
-                                              {"time": [b.result], "file": [self.filename]}))
-        return pd.concat(frames)
+        return self.results.frame()
 
     @abstractmethod
     def run(self) -> DataFrame:
@@ -77,33 +165,224 @@ class BenchBlockCipher(Benchmark):
         }
     ]
 
-    def __init__(self, path: Path, data: bytes, num_iter: int = 10):
-        super().__init__(path, num_iter)
+    def __init__(self, path: Path, data: bytes, **timing):
+        super().__init__(path, **timing)
         self.data = data + b" " * (self.BLOCK_SIZE_BYTES - len(data) % self.BLOCK_SIZE_BYTES)
 
     def run(self) -> DataFrame:
         for a in self._m:
             for mode in a["modes"]:
-                enc_results, dec_results = [], []
-                for i in range(self.num_iter):
-                    bc = BlockCipher(a["algorithm"], mode, self.data)
+                try:
+                    Cipher(a["algorithm"], mode).encryptor()
+                except UnsupportedAlgorithm:
+                    # depends on the version of the backend
+                    continue
+                details = {
+                    "algo": a["algorithm"].name,
+                    "mode": mode.name,
+                }
+                self.measure(details | {"op": "encryption"}, lambda bc: bc.encrypt(),
+                             setup=lambda: BlockCipher(a["algorithm"], mode, self.data), size=len(self.data))
+                encrypted = _encrypted(BlockCipher(a["algorithm"], mode, self.data))
+                self.measure(details | {"op": "decryption"}, lambda bc: bc.decrypt(),
+                             setup=lambda: _holding(BlockCipher(a["algorithm"], mode, self.data), encrypted),
+                             size=len(self.data))
+
+        return self.summarize()
 
-                    start_enc = time.perf_counter()
-                    bc.encrypt()
-                    end_enc = time.perf_counter()
 
-                    start_dec = time.perf_counter()
-                    bc.decrypt()
-                    end_dec = time.perf_counter()
+class BenchRSA(Benchmark):
+    """ Private key operations of 2 and multi-prime keys of the same modulus size, the speedup is relative to
+        the 2 prime key
+    """
+    # a single private key operation already lasts milliseconds
+    REPEAT = 5
+    WARMUP = 1
+    # bytes of the file transformed with every key
+    SAMPLE_SIZE = 4096
 
-                    enc_results.append(end_enc - start_enc)
-                    dec_results.append(end_dec - start_dec)
+    # presets are expensive to generate, they are shared by the benchmarks of all the files
+    _presets: dict[tuple[int, int], dict] = {}
+
+    def __init__(self, path: Path, data: bytes, key_sizes: tuple[int, ...] = (2048, 3072),
+                 primes: tuple[int, ...] = (2, 3, 4), **timing):
+        super().__init__(path, **timing)
+        self.data = data[:self.SAMPLE_SIZE]
+        self.key_sizes = key_sizes
+        self.primes = primes
+
+    def run(self) -> DataFrame:
+        for key_size in self.key_sizes:
+            for primes in self.primes:
+                rsa = RSASimple(key_size=key_size, primes=primes)
+                preset = self._presets.get((key_size, primes)) or rsa.generate_preset()
+                self._presets[(key_size, primes)] = preset
+                encrypted = rsa.encrypt(self.data, "e", preset)
 
                 details = {
-                    "algo": a["algorithm"].name,
-                    "mode": mode.name,
+                    "algo": f"RSA-{key_size}",
+                    "mode": f"{primes} primes",
                 }
-                self.timeit(details | {"op": "encryption"}, mean(enc_results))
-                self.timeit(details | {"op": "decryption"}, mean(dec_results))
+                self.measure(details | {"op": "decryption"}, lambda _: rsa.decrypt(encrypted, "d", preset),
+                             size=len(encrypted))
+                self.measure(details | {"op": "signing"}, lambda _: rsa.encrypt(self.data, "d", preset),
+                             size=len(self.data))
+
+        df = self.summarize()
+        two_primes = df[df["mode"] == "2 primes"].set_index(["algo", "op"])["median"]
+        df["speedup"] = [two_primes.get((algo, op), float("nan")) / t
+                         for algo, op, t in zip(df["algo"], df["op"], df["median"])]
+        return df
+
+
+class BenchCustomModes(Benchmark):
+    """ The hand-written modes against their cryptography counterparts over the same data """
+
+    def __init__(self, path: Path, data: bytes, **timing):
+        super().__init__(path, **timing)
+        self.data = data
+
+    def run(self) -> DataFrame:
+        # the library modes do not pad, give them the data padded the way the custom ones do
+        padded = self.data
+        if tail := len(self.data) % CustomMode.block_size:
+            padded = self.data[:-tail] + CMS.add_padding(self.data[-tail:], CustomMode.block_size)
+        implementations = [
+            (CBCMode(), algorithms.AES(os.urandom(32)), modes.CBC(os.urandom(16))),
+            (CTRMode(), algorithms.AES(os.urandom(32)), modes.CTR(os.urandom(16))),
+        ]
+
+        for custom, algorithm, mode in implementations:
+            details = {
+                "algo": "AES",
+                "mode": f"{custom.name} (custom)",
+            }
+            self.measure(details | {"op": "encryption"}, lambda _: custom.encrypt(self.data), size=len(self.data))
+            ciphertext = custom.encrypt(self.data)
+            self.measure(details | {"op": "decryption"}, custom.decrypt, setup=lambda: ciphertext,
+                         size=len(self.data))
+
+            details = {
+                "algo": "AES",
+                "mode": f"{custom.name} (library)",
+            }
+            self.measure(details | {"op": "encryption"}, lambda bc: bc.encrypt(),
+                         setup=lambda: BlockCipher(algorithm, mode, padded), size=len(padded))
+            encrypted = _encrypted(BlockCipher(algorithm, mode, padded))
+            self.measure(details | {"op": "decryption"}, lambda bc: bc.decrypt(),
+                         setup=lambda: _holding(BlockCipher(algorithm, mode, padded), encrypted), size=len(padded))
 
         return self.summarize()
+
+
+class BenchModeScaling(Benchmark):
+    """ The chunks of the custom CTR mode and of the CBC decryption spread over pools of threads and processes of
+        growing size, the speedup is relative to the single worker
+    """
+    REPEAT = 5
+
+    _executors = {"threads": ThreadPoolExecutor, "processes": ProcessPoolExecutor}
+
+    def __init__(self, path: Path, data: bytes, max_workers: int = 0, **timing):
+        super().__init__(path, **timing)
+        self.data = data
+        max_workers = max_workers or os.cpu_count() or 1
+        # powers of 2 up to the number of cores, and the number of cores itself
+        self.workers = sorted({1 << i for i in range(max_workers.bit_length()) if 1 << i <= max_workers}
+                              | {max_workers})
+
+    def run(self) -> DataFrame:
+        cbc, ctr = CBCMode(), CTRMode()
+        # CBC encryption cannot be split, only the decryption is measured
+        enc_cbc = cbc.encrypt(self.data)
+        enc_ctr = ctr.encrypt(self.data)
+        for executor_name, executor in self._executors.items():
+            for workers in self.workers:
+                cbc.workers = ctr.workers = workers
+                cbc.executor = ctr.executor = executor
+
+                for mode, op, operation, size in [
+                    ("CTR (custom)", "encryption", lambda _: ctr.encrypt(self.data), len(self.data)),
+                    ("CTR (custom)", "decryption", lambda _: ctr.decrypt(enc_ctr), len(enc_ctr)),
+                    ("CBC (custom)", "decryption", lambda _: cbc.decrypt(enc_cbc), len(enc_cbc)),
+                ]:
+                    details = {
+                        "algo": "AES",
+                        "mode": mode,
+                        "op": op,
+                        "pool": executor_name,
+                        "workers": workers,
+                    }
+                    self.measure(details, operation, size=size)
+
+        df = self.summarize()
+        single = df[df["workers"] == 1].set_index(["pool", "mode", "op"])["median"]
+        df["speedup"] = [single.get((pool, mode, op), float("nan")) / t
+                         for pool, mode, op, t in zip(df["pool"], df["mode"], df["op"], df["median"])]
+        return df
+
+
+class BenchBatch(Benchmark):
+    """ The file cut into small records, encrypted with a BlockCipher per record against a single BatchCipher call,
+        the throughput is also given in messages per second
+    """
+    # a BlockCipher per record lasts up to a second for the smallest records
+    REPEAT = 5
+    WARMUP = 1
+    # bytes of the file cut into records
+    SAMPLE_SIZE = 1 << 20
+
+    # mode and length of its IV or nonce
+    _modes = [(modes.CTR, 16), (modes.GCM, 12), (modes.CBC, 16)]
+
+    def __init__(self, path: Path, data: bytes, record_sizes: tuple[int, ...] = (16, 64, 256, 1024), **timing):
+        super().__init__(path, **timing)
+        self.data = data[:self.SAMPLE_SIZE]
+        self.record_sizes = record_sizes
+
+    def run(self) -> DataFrame:
+        algorithm = algorithms.AES(os.urandom(32))
+        for mode, iv_size in self._modes:
+            batch = BatchCipher(algorithm, mode)
+            for record_size in self.record_sizes:
+                # whole records only, CBC does not pad
+                records = [self.data[i:i + record_size]
+                           for i in range(0, len(self.data) - record_size + 1, record_size)]
+                ivs = [os.urandom(iv_size) for _ in records]
+
+                def one_by_one(_):
+                    for record, iv in zip(records, ivs):
+                        BlockCipher(algorithm, mode(iv), record).encrypt()
+
+                for implementation, operation in [("per record", one_by_one),
+                                                  ("batch", lambda _: batch.encrypt_batch(records, ivs))]:
+                    details = {
+                        "algo": algorithm.name,
+                        "mode": f"{mode.name} ({implementation})",
+                        "op": "encryption",
+                        "record": record_size,
+                        "records": len(records),
+                    }
+                    self.measure(details, operation, size=record_size * len(records))
+
+        df = self.summarize()
+        df["messages/s"] = df["records"] / df["median"]
+        return df
+
+
+def _tail(calls: list[float], q: int) -> float:
+    """ q-th percentile of the call times, NaN when too few calls were timed for one of them to lie beyond it """
+    if len(calls) < 100 / (100 - q):
+        return float("nan")
+    return float(np.percentile(calls, q))
+
+
+def _encrypted(bc: BlockCipher) -> BlockCipher:
+    bc.encrypt()
+    return bc
+
+
+def _holding(bc: BlockCipher, encrypted: BlockCipher) -> BlockCipher:
+    """ bc given the ciphertext (and tag) of encrypted, ready to decrypt without encrypting in the timed setup """
+    bc.enc_data, bc.tag = encrypted.enc_data, encrypted.tag
+    return bc
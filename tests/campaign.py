@@ -0,0 +1,116 @@
+import json
+from typing import Iterator
+
+import numpy as np
+from bitarray import bitarray
+from rich.table import Table
+
+from generators.sequence import Sequence
+from tests.config import ConfigBBS
+from tests.test import FIPSStats, FIPS_TESTS, fips_battery
+from utils.parallel import ordered_map
+
+
+class CampaignResults:
+    """ Outcome of the FIPS battery run over many windows of a single sequence """
+
+    def __init__(self, test_names: list[str], starts: list[int], passed: np.ndarray, statistics: np.ndarray):
+        self.test_names = test_names
+        self.starts = starts
+        # both are (windows, tests) shaped
+        self.passed = passed
+        self.statistics = statistics
+
+    def summary(self) -> list[dict]:
+        rows = []
+        for i, name in enumerate(self.test_names):
+            stat = self.statistics[:, i]
+            rows.append({
+                "test": name,
+                "windows": len(self.starts),
+                "passed": int(self.passed[:, i].sum()),
+                "pass_rate": float(self.passed[:, i].mean()) if len(self.starts) else 0.0,
+                **self._distribution(stat),
+            })
+        all_passed = self.passed.all(axis=1) if len(self.starts) else np.zeros(0, dtype=bool)
+        rows.append({
+            "test": "all",
+            "windows": len(self.starts),
+            "passed": int(all_passed.sum()),
+            "pass_rate": float(all_passed.mean()) if len(self.starts) else 0.0,
+        })
+        return rows
+
+    @staticmethod
+    def _distribution(stat: np.ndarray) -> dict:
+        if len(stat) == 0:
+            return {}
+        p1, p50, p99 = np.percentile(stat, [1, 50, 99])
+        return {"min": float(stat.min()), "p1": float(p1), "median": float(p50), "mean": float(stat.mean()),
+                "p99": float(p99), "max": float(stat.max()), "std": float(stat.std())}
+
+    def failed_windows(self) -> list[int]:
+        return [start for start, ok in zip(self.starts, self.passed.all(axis=1)) if not ok]
+
+    def to_json(self) -> str:
+        return json.dumps({"summary": self.summary(), "failed_windows": self.failed_windows()})
+
+    def table(self) -> Table:
+        table = Table(title=f"FIPS 140-2 over {len(self.starts)} windows of {ConfigBBS.SERIES_LENGTH} bits")
+        table.add_column("Test", style="cyan")
+        table.add_column("Pass rate", justify="right", style="green")
+        for column in ["min", "p1", "median", "mean", "p99", "max", "std"]:
+            table.add_column(column, justify="right", style="magenta")
+
+        for row in self.summary():
+            table.add_row(row["test"], f"{row['passed']}/{row['windows']} ({100 * row['pass_rate']:.2f}%)",
+                          *(f"{row[c]:.2f}" if c in row else "" for c in
+                            ["min", "p1", "median", "mean", "p99", "max", "std"]))
+        return table
+
+
+def run_campaign(seq: Sequence, stride: int = ConfigBBS.SERIES_LENGTH, workers: int = 1,
+                 batch: int = 64) -> CampaignResults:
+    """ Run the FIPS battery over every window of ConfigBBS.SERIES_LENGTH bits starting each stride bits
+        Args:
+            seq -- Sequence -- the sequence to qualify
+            stride -- int -- distance between the starts of the consecutive windows
+            workers -- int -- number of processes, the windows are processed in place if 1
+            batch -- int -- number of windows sent to a worker at once
+        return CampaignResults
+    """
+    if stride <= 0:
+        raise ValueError(f"stride must be positive, was: {stride}")
+    starts = list(range(0, len(seq) - ConfigBBS.SERIES_LENGTH + 1, stride))
+    batches = _batches(seq, starts, batch)
+
+    if workers > 1:
+        results = ordered_map(_run_windows, batches, workers)
+    else:
+        results = map(_run_windows, batches)
+
+    passed = np.zeros((len(starts), len(FIPS_TESTS)), dtype=bool)
+    statistics = np.zeros((len(starts), len(FIPS_TESTS)), dtype=np.float64)
+    row = 0
+    for batch_passed, batch_statistics in results:
+        passed[row:row + len(batch_passed)] = batch_passed
+        statistics[row:row + len(batch_passed)] = batch_statistics
+        row += len(batch_passed)
+
+    return CampaignResults([test.name for test in FIPS_TESTS], starts, passed, statistics)
+
+
+def _batches(seq: Sequence, starts: list[int], batch: int) -> Iterator[list[bitarray]]:
+    for i in range(0, len(starts), batch):
+        yield [seq.bits(start, start + ConfigBBS.SERIES_LENGTH) for start in starts[i:i + batch]]
+
+
+def _run_windows(windows: list[bitarray]) -> tuple[np.ndarray, np.ndarray]:
+    passed = np.zeros((len(windows), len(FIPS_TESTS)), dtype=bool)
+    statistics = np.zeros((len(windows), len(FIPS_TESTS)), dtype=np.float64)
+    for i, window in enumerate(windows):
+        battery = fips_battery(FIPSStats.from_bits(window), verbose=False)
+        battery.run()
+        passed[i] = [test.passed for test in battery.tests]
+        statistics[i] = [test.statistic for test in battery.tests]
+    return passed, statistics
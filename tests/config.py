@@ -17,3 +17,33 @@ class ConfigBBS:
         "5": [103, 209],
         "6+": [103, 209],
     }
+
+
+@dataclass
+class ConfigNIST:
+    # significance level, a test passes if its p-value is at least ALPHA
+    ALPHA = 0.01
+    BLOCK_FREQUENCY_BLOCK_LENGTH = 128
+    # fewer blocks leave the chi-square statistic with too few degrees of freedom to mean anything
+    BLOCK_FREQUENCY_MIN_BLOCKS = 10
+    # (minimum sequence length, block length, longest run classes, class probabilities), SP 800-22 section 2.4
+    LONGEST_RUN_TABLE = [
+        (750000, 10000, [10, 11, 12, 13, 14, 15, 16], [0.0882, 0.2092, 0.2483, 0.1933, 0.1208, 0.0675, 0.0727]),
+        (6272, 128, [4, 5, 6, 7, 8, 9], [0.1174, 0.2430, 0.2493, 0.1752, 0.1027, 0.1124]),
+        (128, 8, [1, 2, 3, 4], [0.2148, 0.3672, 0.2305, 0.1875]),
+    ]
+    DFT_THRESHOLD_PROBABILITY = 0.95
+    # the block lengths are capped so that the pattern counts stay meaningful for short sequences
+    APPROXIMATE_ENTROPY_BLOCK_LENGTH = 10
+    SERIAL_BLOCK_LENGTH = 16
+
+
+@dataclass
+class ConfigBench:
+    # untimed calls before the calibration, to fill the caches and settle the allocator
+    WARMUP = 2
+    # timed samples of every measurement
+    REPEAT = 15
+    # a sample repeats the operation until it lasts at least MIN_TIME seconds, so that short operations are not
+    # lost in the resolution of the clock
+    MIN_TIME = 0.02
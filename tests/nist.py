@@ -0,0 +1,268 @@
+from abc import ABCMeta, abstractmethod
+from math import erfc, exp, floor, lgamma, log, log2, sqrt
+from typing import Union
+
+import numpy as np
+from bitarray import bitarray
+
+from tests.config import ConfigNIST
+from tests.test import TestInterface, Tests, as_bits, unpack
+
+
+def nist_run_tests(bits: Union[str, bitarray], keys: list[str] = None) -> bool:
+    return nist_battery(as_bits(bits), keys).run()
+
+
+def nist_battery(bits: bitarray, keys: list[str] = None, verbose: bool = True) -> Tests:
+    """ Build the selected NIST SP 800-22 tests, all of them if no keys are given """
+    keys = keys or list(NIST_TESTS.keys())
+    unknown = [key for key in keys if key not in NIST_TESTS]
+    if unknown:
+        raise ValueError(f"unknown NIST tests: {unknown}, expected any of: {list(NIST_TESTS.keys())}")
+
+    unpacked = unpack(bits)
+    tests = Tests(verbose)
+    tests.register(*(NIST_TESTS[key](unpacked, verbose) for key in keys))
+    return tests
+
+
+class NISTTest(TestInterface, metaclass=ABCMeta):
+    expected = f"p ≥ {ConfigNIST.ALPHA}"
+    # minimum sequence length for which the test is meaningful
+    min_length = 100
+
+    def __init__(self, bits: np.ndarray, verbose: bool = True):
+        super().__init__(verbose)
+        # one uint8 (0 or 1) per bit
+        self.bits = bits
+
+    def run(self):
+        n = len(self.bits)
+        if n < self.min_length:
+            self.assert_true(predicate=lambda: False, result=f"sequence too short, need at least {self.min_length}",
+                             statistic=0.0)
+            return
+
+        p_values = self.p_values()
+        p_min = min(p_values)
+        self.assert_true(
+            predicate=lambda: p_min >= ConfigNIST.ALPHA,
+            result=", ".join(f"p = {p:.6f}" for p in p_values),
+            statistic=p_min)
+
+    @abstractmethod
+    def p_values(self) -> list[float]:
+        raise NotImplementedError
+
+    def _signed(self) -> np.ndarray:
+        """ The sequence mapped to ±1 """
+        return 2 * self.bits.astype(np.int64) - 1
+
+
+class TestFrequency(NISTTest):
+    name = "frequency (monobit)"
+
+    def p_values(self) -> list[float]:
+        n = len(self.bits)
+        s_obs = abs(2 * int(np.count_nonzero(self.bits)) - n) / sqrt(n)
+        return [erfc(s_obs / sqrt(2))]
+
+
+class TestBlockFrequency(NISTTest):
+    name = "block frequency"
+    min_length = ConfigNIST.BLOCK_FREQUENCY_BLOCK_LENGTH * ConfigNIST.BLOCK_FREQUENCY_MIN_BLOCKS
+
+    def p_values(self) -> list[float]:
+        m = ConfigNIST.BLOCK_FREQUENCY_BLOCK_LENGTH
+        blocks = len(self.bits) // m
+        if blocks == 0:
+            # igamc(0, 0) is 1, an empty sequence would pass
+            return [0.0]
+        pi = self.bits[:blocks * m].reshape(blocks, m).sum(axis=1) / m
+        chi2 = 4 * m * float(np.sum((pi - 0.5) ** 2))
+        return [igamc(blocks / 2, chi2 / 2)]
+
+
+class TestRuns(NISTTest):
+    name = "runs"
+
+    def p_values(self) -> list[float]:
+        n = len(self.bits)
+        pi = np.count_nonzero(self.bits) / n
+        # frequency prerequisite, the test is not applicable (and failed) otherwise
+        if abs(pi - 0.5) >= 2 / sqrt(n):
+            return [0.0]
+        v_obs = 1 + int(np.count_nonzero(self.bits[1:] != self.bits[:-1]))
+        return [erfc(abs(v_obs - 2 * n * pi * (1 - pi)) / (2 * sqrt(2 * n) * pi * (1 - pi)))]
+
+
+class TestLongestRunOfOnes(NISTTest):
+    name = "longest run of ones in a block"
+    min_length = 128
+
+    def p_values(self) -> list[float]:
+        n = len(self.bits)
+        m, classes, probabilities = next((m, c, p) for min_n, m, c, p in ConfigNIST.LONGEST_RUN_TABLE if n >= min_n)
+        blocks = n // m
+
+        longest = longest_runs_of_ones(self.bits[:blocks * m].reshape(blocks, m))
+        observed = np.bincount(np.clip(longest, classes[0], classes[-1]) - classes[0], minlength=len(classes))
+        expected = blocks * np.array(probabilities)
+        chi2 = float(np.sum((observed - expected) ** 2 / expected))
+        return [igamc((len(classes) - 1) / 2, chi2 / 2)]
+
+
+class TestDFT(NISTTest):
+    name = "discrete Fourier transform (spectral)"
+    min_length = 1000
+
+    def p_values(self) -> list[float]:
+        n = len(self.bits)
+        modulus = np.abs(np.fft.rfft(self._signed().astype(np.float64))[:n // 2])
+        threshold = sqrt(log(1 / (1 - ConfigNIST.DFT_THRESHOLD_PROBABILITY)) * n)
+        n_0 = ConfigNIST.DFT_THRESHOLD_PROBABILITY * n / 2
+        n_1 = int(np.count_nonzero(modulus < threshold))
+        d = (n_1 - n_0) / sqrt(n * ConfigNIST.DFT_THRESHOLD_PROBABILITY * (1 - ConfigNIST.DFT_THRESHOLD_PROBABILITY) / 4)
+        return [erfc(abs(d) / sqrt(2))]
+
+
+class TestApproximateEntropy(NISTTest):
+    name = "approximate entropy"
+
+    def p_values(self) -> list[float]:
+        n = len(self.bits)
+        m = max(1, min(ConfigNIST.APPROXIMATE_ENTROPY_BLOCK_LENGTH, floor(log2(n)) - 6))
+        ap_en = _phi(self.bits, m) - _phi(self.bits, m + 1)
+        chi2 = 2 * n * (log(2) - ap_en)
+        return [igamc(2 ** (m - 1), chi2 / 2)]
+
+
+class TestCumulativeSums(NISTTest):
+    name = "cumulative sums (forward, backward)"
+
+    def p_values(self) -> list[float]:
+        n = len(self.bits)
+        signed = self._signed()
+        forward = int(np.abs(np.cumsum(signed)).max())
+        backward = int(np.abs(np.cumsum(signed[::-1])).max())
+        return [_cumulative_sums_p_value(n, forward), _cumulative_sums_p_value(n, backward)]
+
+
+class TestSerial(NISTTest):
+    name = "serial"
+
+    def p_values(self) -> list[float]:
+        n = len(self.bits)
+        m = max(3, min(ConfigNIST.SERIAL_BLOCK_LENGTH, floor(log2(n)) - 3))
+        psi_m, psi_m1, psi_m2 = (_psi_squared(self.bits, k) for k in (m, m - 1, m - 2))
+        delta = psi_m - psi_m1
+        delta_2 = psi_m - 2 * psi_m1 + psi_m2
+        return [igamc(2 ** (m - 2), delta / 2), igamc(2 ** (m - 3), delta_2 / 2)]
+
+
+def longest_runs_of_ones(blocks: np.ndarray) -> np.ndarray:
+    """ Longest run of ones in every row, from the positions where the runs start and end """
+    rows, m = blocks.shape
+    padded = np.zeros((rows, m + 2), dtype=np.int8)
+    padded[:, 1:-1] = blocks
+    diff = np.diff(padded, axis=1)
+    start_rows, start_cols = np.nonzero(diff == 1)
+    _, end_cols = np.nonzero(diff == -1)
+    longest = np.zeros(rows, dtype=np.int64)
+    np.maximum.at(longest, start_rows, end_cols - start_cols)
+    return longest
+
+
+def pattern_counts(bits: np.ndarray, m: int) -> np.ndarray:
+    """ Occurrences of every overlapping m bit pattern, the sequence is extended with its first m - 1 bits """
+    n = len(bits)
+    extended = np.concatenate((bits, bits[:m - 1])).astype(np.uint32)
+    values = np.zeros(n, dtype=np.uint32)
+    for j in range(m):
+        values <<= 1
+        values |= extended[j:j + n]
+    return np.bincount(values, minlength=2 ** m)
+
+
+def _phi(bits: np.ndarray, m: int) -> float:
+    counts = pattern_counts(bits, m)
+    c = counts[counts > 0] / len(bits)
+    return float(np.sum(c * np.log(c)))
+
+
+def _psi_squared(bits: np.ndarray, m: int) -> float:
+    if m <= 0:
+        return 0.0
+    n = len(bits)
+    counts = pattern_counts(bits, m).astype(np.float64)
+    return float((2 ** m) / n * np.dot(counts, counts) - n)
+
+
+def _normal_cdf(x: float) -> float:
+    return 0.5 * erfc(-x / sqrt(2))
+
+
+def _cumulative_sums_p_value(n: int, z: int) -> float:
+    root_n = sqrt(n)
+    total = 1.0
+    for k in range(floor((-n / z + 1) / 4), floor((n / z - 1) / 4) + 1):
+        total -= _normal_cdf((4 * k + 1) * z / root_n) - _normal_cdf((4 * k - 1) * z / root_n)
+    for k in range(floor((-n / z - 3) / 4), floor((n / z - 1) / 4) + 1):
+        total += _normal_cdf((4 * k + 3) * z / root_n) - _normal_cdf((4 * k + 1) * z / root_n)
+    return min(1.0, max(0.0, total))
+
+
+def igamc(a: float, x: float) -> float:
+    """ Regularized upper incomplete gamma function Q(a, x)
+        Args:
+            a -- float -- shape, a > 0
+            x -- float -- lower integration bound
+        return Q(a, x)
+    """
+    if x <= 0:
+        return 1.0
+    eps, tiny, max_iterations = 1e-15, 1e-300, 1_000_000
+    log_prefix = -x + a * log(x) - lgamma(a)
+
+    if x < a + 1:
+        # series expansion of the lower function P(a, x)
+        term = total = 1 / a
+        ap = a
+        for _ in range(max_iterations):
+            ap += 1
+            term *= x / ap
+            total += term
+            if abs(term) < abs(total) * eps:
+                break
+        return max(0.0, 1.0 - total * exp(log_prefix))
+
+    # continued fraction (modified Lentz) for Q(a, x)
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, max_iterations):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < eps:
+            break
+    return exp(log_prefix) * h
+
+
+NIST_TESTS = {
+    "frequency": TestFrequency,
+    "block-frequency": TestBlockFrequency,
+    "runs": TestRuns,
+    "longest-run": TestLongestRunOfOnes,
+    "dft": TestDFT,
+    "approximate-entropy": TestApproximateEntropy,
+    "cumulative-sums": TestCumulativeSums,
+    "serial": TestSerial,
+}
@@ -0,0 +1,46 @@
+import numpy as np
+from bitarray import bitarray
+
+from tests.campaign import CampaignResults
+from tests.config import ConfigBBS
+from tests.test import FIPSAccumulator, FIPSStats, FIPS_TESTS, fips_battery
+
+
+class WindowedFIPS:
+    """ Run the FIPS battery over consecutive windows of a sequence as it is being produced,
+        only the statistics of the current window are kept in memory
+    """
+
+    def __init__(self, window: int = ConfigBBS.SERIES_LENGTH):
+        self.window = window
+        self.last_stats: FIPSStats = FIPSStats.empty()
+        self._accumulator = FIPSAccumulator()
+        self._starts: list[int] = []
+        self._passed: list[list[bool]] = []
+        self._statistics: list[list[float]] = []
+
+    def update(self, chunk: bitarray):
+        position = 0
+        while position < len(chunk):
+            take = min(self.window - self._accumulator.length, len(chunk) - position)
+            self._accumulator.update(chunk[position:position + take] if take < len(chunk) else chunk)
+            position += take
+            if self._accumulator.length == self.window:
+                self._close_window()
+
+    def results(self) -> CampaignResults:
+        # a sequence shorter than a single window is still reported, and fails the series length test
+        if not self._starts and self._accumulator.length:
+            self._close_window()
+        return CampaignResults([test.name for test in FIPS_TESTS], self._starts,
+                               np.array(self._passed, dtype=bool).reshape(-1, len(FIPS_TESTS)),
+                               np.array(self._statistics, dtype=np.float64).reshape(-1, len(FIPS_TESTS)))
+
+    def _close_window(self):
+        self.last_stats = self._accumulator.result()
+        battery = fips_battery(self.last_stats, verbose=False)
+        battery.run()
+        self._starts.append(len(self._starts) * self.window)
+        self._passed.append([test.passed for test in battery.tests])
+        self._statistics.append([test.statistic for test in battery.tests])
+        self._accumulator = FIPSAccumulator()
@@ -1,7 +1,11 @@
 from abc import ABCMeta, abstractmethod
-import itertools
-from typing import Callable
+from dataclasses import dataclass, replace
+from typing import Callable, Union
 
+import numpy as np
+from bitarray import bitarray
+
+from generators.sequence import Sequence
 from tests.config import ConfigBBS
 
 from rich.console import Console
@@ -9,7 +13,8 @@ from rich.console import Console
 console = Console()
 
 
-def bbs_run_tests(bits: str):
+def bbs_run_tests(bits: Union[str, bitarray, Sequence]):
+    """ FIPS 140-2 battery over the first SERIES_LENGTH bits or a chosen subset, only that range is read """
     if len(bits) > ConfigBBS.SERIES_LENGTH:
         print(f"Sequence is too long, expecting {ConfigBBS.SERIES_LENGTH} length.\n"
               f"Do you want to cut it or select a subset?")
@@ -25,48 +30,162 @@ def bbs_run_tests(bits: str):
         else:
             raise ValueError("invalid argument provided, expected either 'c' or 's'")
 
-    Tests.register(
-        TestSeriesLength(bits),
-        TestSingleBits(bits),
-        TestSeries(bits),
-        TestLongSeries(bits),
-        TestPoker(bits))
-    Tests.run()
+    fips_battery(FIPSStats.from_bits(bits[:] if isinstance(bits, Sequence) else bits)).run()
 
 
-class Tests:
-    tests: list["TestInterface"] = []
+def fips_battery(stats: "FIPSStats", verbose: bool = True) -> "Tests":
+    tests = Tests(verbose)
+    tests.register(*(test(stats, verbose) for test in FIPS_TESTS))
+    return tests
+
+
+def as_bits(bits: Union[str, bitarray]) -> bitarray:
+    if isinstance(bits, bitarray):
+        return bits
+    return bitarray(bits, endian="big")
+
+
+def unpack(bits: bitarray) -> np.ndarray:
+    """ One uint8 per bit, read straight from the (big endian) bitarray buffer """
+    return np.unpackbits(np.frombuffer(bits, dtype=np.uint8), count=len(bits))
+
+
+def nibbles(bits: bitarray) -> np.ndarray:
+    """ Consecutive, non-overlapping 4 bit values, the incomplete trailing nibble is dropped """
+    packed = np.frombuffer(bits, dtype=np.uint8)
+    values = np.empty(2 * len(packed), dtype=np.uint8)
+    values[0::2] = packed >> 4
+    values[1::2] = packed & 0x0F
+    return values[:len(bits) // 4]
+
+
+@dataclass
+class FIPSStats:
+    """ Everything the FIPS 140-2 tests need to know about a sequence """
+    length: int
+    ones: int
+    # runs[bit][k - 1] is the number of runs of the given bit of length k, the last column counts runs of 6+
+    runs: np.ndarray
+    longest_run: int
+    # number of occurrences of each of the 16 nibble values
+    nibbles: np.ndarray
 
     @staticmethod
-    def register(*tests: "TestInterface"):
-        [Tests.tests.append(test) for test in tests]
+    def empty() -> "FIPSStats":
+        return FIPSStats(0, 0, np.zeros((2, 6), dtype=np.int64), 0, np.zeros(16, dtype=np.int64))
 
     @staticmethod
-    def run():
+    def from_bits(bits: Union[str, bitarray]) -> "FIPSStats":
+        accumulator = FIPSAccumulator()
+        accumulator.update(as_bits(bits))
+        return accumulator.result()
+
+    def copy(self) -> "FIPSStats":
+        return replace(self, runs=self.runs.copy(), nibbles=self.nibbles.copy())
+
+    def _count_runs(self, values: np.ndarray, lengths: np.ndarray):
+        if len(lengths) == 0:
+            return
+        for bit in (0, 1):
+            self.runs[bit] += np.bincount(np.minimum(lengths[values == bit], 6), minlength=7)[1:]
+        self.longest_run = max(self.longest_run, int(lengths.max()))
+
+
+class FIPSAccumulator:
+    """ Online FIPSStats, updated chunk by chunk with the state carried across the chunk boundaries """
+
+    # bits processed at once, bounds the size of the intermediate arrays for long chunks
+    CHUNK_BITS = 1 << 23
+
+    def __init__(self):
+        self._stats = FIPSStats.empty()
+        # the last run of a chunk may continue in the next one, it is only counted once it ends
+        self._open_bit, self._open_length = 0, 0
+        # bits of an incomplete trailing nibble, prepended to the next chunk
+        self._nibble_carry = bitarray(endian="big")
+
+    @property
+    def length(self) -> int:
+        return self._stats.length
+
+    def update(self, bits: bitarray):
+        for start in range(0, len(bits), self.CHUNK_BITS):
+            self._update(bits[start:start + self.CHUNK_BITS] if len(bits) > self.CHUNK_BITS else bits)
+
+    def _update(self, chunk: bitarray):
+        values, lengths = run_lengths(chunk)
+        if self._open_length and values[0] == self._open_bit:
+            lengths[0] += self._open_length
+        elif self._open_length:
+            self._stats._count_runs(np.array([self._open_bit]), np.array([self._open_length]))
+        self._stats._count_runs(values[:-1], lengths[:-1])
+        self._open_bit, self._open_length = int(values[-1]), int(lengths[-1])
+
+        self._stats.length += len(chunk)
+        self._stats.ones += chunk.count(1)
+
+        if self._nibble_carry:
+            chunk = self._nibble_carry + chunk
+        self._stats.nibbles += np.bincount(nibbles(chunk), minlength=16)
+        self._nibble_carry = chunk[len(chunk) - len(chunk) % 4:]
+
+    def result(self) -> FIPSStats:
+        """ Stats of everything seen so far, the accumulator can still be updated afterwards """
+        stats = self._stats.copy()
+        if self._open_length:
+            stats._count_runs(np.array([self._open_bit]), np.array([self._open_length]))
+        return stats
+
+
+def run_lengths(bits: bitarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Bit value and length of every run, found through the positions where the bit value changes """
+    unpacked = unpack(bits)
+    boundaries = np.flatnonzero(unpacked[1:] != unpacked[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(unpacked)]))
+    return unpacked[starts], ends - starts
+
+
+class Tests:
+
+    def __init__(self, verbose: bool = True):
+        self.verbose = verbose
+        self.tests: list["TestInterface"] = []
+
+    def register(self, *tests: "TestInterface"):
+        self.tests.extend(tests)
+
+    def run(self) -> bool:
         all_tests_passed = True
-        for test in Tests.tests:
+        for test in self.tests:
             test.run()
             if not test.passed:
                 all_tests_passed = False
+        if not self.verbose:
+            return all_tests_passed
         if all_tests_passed:
             console.print("[bold green][SUCCESS][/bold green] All tests have passed!")
         else:
             console.print("[bold red][FAILURE][/bold red] Some of the tests have failed!")
+        return all_tests_passed
 
 
 class TestInterface(metaclass=ABCMeta):
-    passed: bool = True
     name: str = "none"
     expected: any = "none"
 
-    def __init__(self, bits: str):
+    def __init__(self, verbose: bool = True):
         if self.name in ["none", ""]:
             raise NotImplementedError("'name' must be set to a description of the test to be run")
         if self.expected in ["none", ""]:
             raise NotImplementedError("'expected' must be set to a description of the expected result of the test")
-        self.bits = bits
+        self.verbose = verbose
+        self.passed = True
+        # numeric summary of the result, used to build distributions over many sequences
+        self.statistic: float = 0.0
 
-    def assert_true(self, predicate: Callable[[], bool], result: any):
+    def assert_true(self, predicate: Callable[[], bool], result: any, statistic: float):
+        self.statistic = statistic
         self._passing(result) if predicate() else self._failing(result)
 
     def _failing(self, result: any):
@@ -77,6 +196,8 @@ class TestInterface(metaclass=ABCMeta):
         self._print("[bold green][PASS][/bold green]", result)
 
     def _print(self, outcome: str, result: any):
+        if not self.verbose:
+            return
         console.print(f"{outcome} Test: {self.name}\n"
                       f" • [yellow]Expected:[/yellow] {self.expected}\n"
                       f" • [blue]Result:[/blue]   {result}")
@@ -86,92 +207,88 @@ class TestInterface(metaclass=ABCMeta):
         raise NotImplementedError
 
 
-class TestSeriesLength(TestInterface):
+class FIPSTest(TestInterface, metaclass=ABCMeta):
+
+    def __init__(self, stats: FIPSStats, verbose: bool = True):
+        super().__init__(verbose)
+        self.stats = stats
+
+
+class TestSeriesLength(FIPSTest):
     name = "series length"
     expected = ConfigBBS.SERIES_LENGTH
 
     def run(self):
-        length = len(self.bits)
+        length = self.stats.length
         self.assert_true(
             predicate=lambda: length == ConfigBBS.SERIES_LENGTH,
-            result=length)
+            result=length,
+            statistic=length)
 
 
-class TestSeries(TestInterface):
+class TestSeries(FIPSTest):
     name = "series"
     expected = f"{ConfigBBS.SERIES_TEST_TABLE}"
 
     def run(self):
-        series_occurrences = {bit: {k: 0 for k in ConfigBBS.SERIES_TEST_TABLE.keys()} for bit in ["0", "1"]}
-        previous_bit, series_ctr = "0", 0
-        for bit in self.bits:
-            series_ctr += 1
-            if previous_bit != bit:
-                series_key = str(series_ctr) if series_ctr < 6 else "6+"
-                series_occurrences[previous_bit][series_key] += 1
-                series_ctr = 0
-            previous_bit = bit
+        series_occurrences = {str(bit): {k: int(occurrences)
+                                         for k, occurrences in zip(ConfigBBS.SERIES_TEST_TABLE.keys(), runs)}
+                              for bit, runs in enumerate(self.stats.runs)}
 
+        out_of_bounds = self._out_of_bounds(series_occurrences)
         self.assert_true(
-            predicate=lambda: self._compare_series(series_occurrences),
-            result=series_occurrences)
+            predicate=lambda: out_of_bounds == 0,
+            result=series_occurrences,
+            statistic=out_of_bounds)
 
     @staticmethod
-    def _compare_series(series_occurrences: dict) -> bool:
+    def _out_of_bounds(series_occurrences: dict) -> int:
+        """ Number of the series lengths (for both bits) whose count is out of the expected range """
+        failed = 0
         for bit, series in series_occurrences.items():
             for s, occurrences in series.items():
                 v = ConfigBBS.SERIES_TEST_TABLE[s]
                 if not v[0] < occurrences < v[1]:
-                    return False
-        return True
+                    failed += 1
+        return failed
 
 
-class TestSingleBits(TestInterface):
+class TestSingleBits(FIPSTest):
     name = "single bits"
     expected = f"{ConfigBBS.SINGLE_BITS_LOWER_BOUND} < n < {ConfigBBS.SINGLE_BITS_UPPER_BOUND}"
 
     def run(self):
-        ones_num = len(list(filter(lambda x: x == "1", self.bits)))
+        ones_num = self.stats.ones
         self.assert_true(
             predicate=lambda: ConfigBBS.SINGLE_BITS_LOWER_BOUND < ones_num < ConfigBBS.SINGLE_BITS_UPPER_BOUND,
-            result=f"n = {ones_num}")
+            result=f"n = {ones_num}",
+            statistic=ones_num)
 
 
-class TestLongSeries(TestInterface):
+class TestLongSeries(FIPSTest):
     name = "long series"
     expected = "s < 26"
 
     def run(self):
-        current_bit = ""
-        ctr, longest_sequence = 0, 0
-        for bit in self.bits:
-            if bit != current_bit:
-                if ctr > longest_sequence:
-                    longest_sequence = ctr
-                ctr = 0
-                current_bit = bit
-            ctr += 1
-        # IF we ended with the longest sequence
-        if ctr > longest_sequence:
-            longest_sequence = ctr
-
+        longest_sequence = self.stats.longest_run
         self.assert_true(
             predicate=lambda: longest_sequence < ConfigBBS.LONG_SERIES_LENGTH,
-            result=f"s = {longest_sequence}")
+            result=f"s = {longest_sequence}",
+            statistic=longest_sequence)
 
 
-class TestPoker(TestInterface):
+class TestPoker(FIPSTest):
     name = "poker"
     expected = f"{ConfigBBS.POKER_X_LOWER_BOUND} < x < {ConfigBBS.POKER_X_UPPER_BOUND}"
 
     def run(self):
-        four_bit_occurrences = {"".join(seq): 0 for seq in itertools.product("01", repeat=4)}
-        four_bit_sequences = map(lambda x: "".join(x), zip(*(self.bits[i::4] for i in range(4))))
-        for seq in four_bit_sequences:
-            four_bit_occurrences[seq] += 1
-
-        x = (16 / 5000) * sum(map(lambda y: y ** 2, four_bit_occurrences.values())) - 5000
+        k = int(self.stats.nibbles.sum())
+        x = (16 / k) * float(np.dot(self.stats.nibbles, self.stats.nibbles)) - k if k else 0.0
 
         self.assert_true(
             predicate=lambda: ConfigBBS.POKER_X_LOWER_BOUND < x < ConfigBBS.POKER_X_UPPER_BOUND,
-            result=f"x = {x}")
+            result=f"x = {x}",
+            statistic=x)
+
+
+FIPS_TESTS = [TestSeriesLength, TestSingleBits, TestSeries, TestLongSeries, TestPoker]
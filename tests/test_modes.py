@@ -0,0 +1,34 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from cipher.block import CBCMode, CTRMode
+
+
+class TestModeFiles(unittest.TestCase):
+    """ Files encrypted and decrypted by the custom modes come back unchanged """
+
+    def _round_trip(self, mode, data: bytes) -> bytes:
+        with tempfile.TemporaryDirectory() as directory:
+            plain, enc, dec = (Path(directory).joinpath(name) for name in ("plain", "enc", "dec"))
+            plain.write_bytes(data)
+            mode.encrypt_file(str(plain), str(enc))
+            mode.decrypt_file(str(enc), str(dec))
+            return dec.read_bytes()
+
+    def test_aligned_input_ending_like_a_padding(self):
+        for mode in (CBCMode(), CTRMode()):
+            for tail in (b"\x01", b"\x02\x02", 16 * b"\x10"):
+                data = os.urandom(32 - len(tail)) + tail
+                self.assertEqual(self._round_trip(mode, data), data, f"{mode.name} {tail!r}")
+
+    def test_lengths_around_a_block(self):
+        for mode in (CBCMode(), CTRMode()):
+            for length in (0, 1, 15, 16, 17, 100):
+                data = os.urandom(length)
+                self.assertEqual(self._round_trip(mode, data), data, f"{mode.name} {length}")
+
+
+if __name__ == "__main__":
+    unittest.main()
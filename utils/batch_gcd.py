@@ -0,0 +1,212 @@
+import json
+import struct
+import tempfile
+from contextlib import nullcontext
+from math import gcd
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from utils.pool import PrimePool
+
+try:
+    # GMP multiplies and divides in quasi-linear time, CPython integers only with Karatsuba and schoolbook division
+    from gmpy2 import mpz
+except ImportError:
+    mpz = None
+
+_LENGTH = struct.Struct(">Q")
+# bit length up to which a reciprocal is computed by a plain division
+RECIPROCAL_THRESHOLD = 1 << 14
+
+
+class _Level:
+    """ One level of a product or remainder tree, in memory or spilled to a file of length prefixed integers """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self._items: list[int] = []
+        self._file = open(path, "wb") if path else None
+        self._len = 0
+
+    def append(self, x: int):
+        self._len += 1
+        if not self._file:
+            self._items.append(x)
+            return
+        x = int(x)
+        data = x.to_bytes((x.bit_length() + 7) // 8, "big")
+        self._file.write(_LENGTH.pack(len(data)))
+        self._file.write(data)
+
+    def close(self) -> "_Level":
+        if self._file:
+            self._file.close()
+            self._file = None
+        return self
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[int]:
+        if not self.path:
+            yield from self._items
+            return
+        with open(self.path, "rb") as f:
+            while header := f.read(_LENGTH.size):
+                yield _number(int.from_bytes(f.read(_LENGTH.unpack(header)[0]), "big"))
+
+
+def batch_gcd(moduli: list[int], spill_dir: Optional[str] = None) -> list[int]:
+    """ gcd(n_i, product of all the other moduli) for every modulus, through a product tree and a scaled remainder
+        tree (D. J. Bernstein, "Scaled remainder trees"), which only multiplies on the way down, so that the cost
+        follows the one of the multiplication: quasi-linear with gmpy2 installed, Karatsuba with CPython integers
+        Args:
+            moduli -- list[int] -- distinct moduli
+            spill_dir -- Optional[str] -- directory in which the tree levels are kept instead of memory
+        return the gcd of every modulus, 1 if it shares no factor, the modulus itself if it shares all of them
+    """
+    if len(moduli) < 2:
+        return [1] * len(moduli)
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) if spill_dir else nullcontext() as directory:
+        def new_level(name: str) -> _Level:
+            return _Level(Path(directory).joinpath(name) if directory else None)
+
+        # product tree, from the moduli up to the product of all of them
+        levels = [new_level("product.0")]
+        for n in moduli:
+            levels[0].append(_number(n))
+        levels[0].close()
+        while len(levels[-1]) > 1:
+            upper = new_level(f"product.{len(levels)}")
+            for pair in _pairs(levels[-1]):
+                upper.append(pair[0] * pair[1] if len(pair) == 2 else pair[0])
+            levels.append(upper.close())
+
+        # every node v holds the fraction P / v² mod 1 as a fixed point number of _precision(v, guard) bits, the
+        # guard bits absorb the truncation errors, which at most triple on every level
+        guard = 3 * len(levels) + 16
+        product, = levels[-1]
+        fractions = new_level(f"fraction.{len(levels) - 1}")
+        # P / P² = 1 / P
+        fractions.append(_reciprocal(product << guard))
+        fractions.close()
+
+        for depth in range(len(levels) - 2, -1, -1):
+            lower = new_level(f"fraction.{depth}")
+            nodes = iter(levels[depth])
+            for t, parent in zip(fractions, levels[depth + 1]):
+                parent_precision = _precision(parent, guard)
+                children = _take(nodes, 2)
+                for i, child in enumerate(children):
+                    # P / child² = P / parent² · sibling²
+                    sibling = children[1 - i] if len(children) == 2 else 1
+                    x = (t * (sibling * sibling)) & ((1 << parent_precision) - 1)
+                    lower.append(x >> (parent_precision - _precision(child, guard)))
+            fractions = lower.close()
+
+        gcds = []
+        for t, n in zip(fractions, moduli):
+            precision = _precision(n, guard)
+            # P mod n² is an integer, the rounding removes the error of the fraction
+            r = ((t * n * n + (1 << (precision - 1))) >> precision) % (n * n)
+            gcds.append(gcd(int(r) // n, n))
+        return gcds
+
+
+def shared_factors(moduli: list[int], spill_dir: Optional[str] = None) -> list[tuple[int, int, int]]:
+    """ Every pair of moduli sharing a factor
+        Args:
+            moduli -- list[int] -- distinct moduli
+            spill_dir -- Optional[str] -- see batch_gcd
+        return (i, j, gcd(n_i, n_j)) for every such pair, i < j
+    """
+    vulnerable = [i for i, g in enumerate(batch_gcd(moduli, spill_dir)) if g != 1]
+    # only the few vulnerable moduli are compared pairwise, to tell which of them collide with which
+    pairs = []
+    for a, i in enumerate(vulnerable):
+        for j in vulnerable[a + 1:]:
+            if (g := gcd(moduli[i], moduli[j])) != 1:
+                pairs.append((i, j, g))
+    return pairs
+
+
+def load_moduli(paths: Iterable[str]) -> dict[int, list[str]]:
+    """ Moduli found in the files (directories are searched recursively):
+            JSON presets or Blum keys -- every "n" of every object, at any depth
+            anything else -- one integer per line, like numbers/blum.integer
+        The primes of the prime pool are skipped
+        return the labels (file, optionally the location in it) of every distinct modulus
+    """
+    found: dict[int, list[str]] = {}
+    for path in paths:
+        path = Path(path)
+        files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+        for file in files:
+            if file.name.endswith(PrimePool.SUFFIX):
+                continue
+            for label, n in _read_moduli(file):
+                found.setdefault(n, []).append(label)
+    return found
+
+
+def _read_moduli(file: Path) -> Iterator[tuple[str, int]]:
+    text = file.read_text(errors="replace")
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError:
+        value = None
+    if isinstance(value, (dict, list)):
+        yield from ((f"{file}{location}", n) for location, n in _json_moduli(value, ""))
+        return
+    for i, line in enumerate(text.splitlines()):
+        if line.strip().isdigit() and int(line) > 1:
+            yield f"{file}:{i + 1}", int(line)
+
+
+def _json_moduli(value, location: str) -> Iterator[tuple[str, int]]:
+    if isinstance(value, dict):
+        if isinstance(value.get("n"), int):
+            yield location, value["n"]
+        for key, child in value.items():
+            yield from _json_moduli(child, f"{location}.{key}")
+    elif isinstance(value, list):
+        for i, child in enumerate(value):
+            yield from _json_moduli(child, f"{location}[{i}]")
+
+
+def _number(n: int):
+    return mpz(n) if mpz else n
+
+
+def _precision(v, guard: int) -> int:
+    return 2 * v.bit_length() + guard
+
+
+def _reciprocal(m):
+    """ floor(2^2k / m), k the bit length of m, by a Newton iteration from the reciprocal of the top half of m """
+    k = m.bit_length()
+    if k <= RECIPROCAL_THRESHOLD:
+        return (1 << 2 * k) // m
+    h = k // 2 + 16
+    y = _reciprocal(m >> (k - h)) << (k - h)
+    y += (y * ((1 << 2 * k) - m * y)) >> (2 * k)
+    # the iteration leaves y off by a few units at most
+    r = (1 << 2 * k) - m * y
+    while r < 0:
+        y -= 1
+        r += m
+    while r >= m:
+        y += 1
+        r -= m
+    return y
+
+
+def _pairs(level: Iterable[int]) -> Iterator[list[int]]:
+    nodes = iter(level)
+    while pair := _take(nodes, 2):
+        yield pair
+
+
+def _take(nodes: Iterator[int], count: int) -> list[int]:
+    return [node for _, node in zip(range(count), nodes)]
@@ -1,22 +1,56 @@
-from utils.prime import generate_prime_number
+import json
+from typing import Optional
+
+from utils.pool import PrimePool, PrimeSpec
+from utils.prime import generate_prime_number, generate_primes
+from utils.private import open_private
 
 from rich.console import Console
 
 console = Console()
 
+BLUM_KEY_PATH = "numbers/blum.key"
+
+
+def generate_blum_integer(p_len=512, q_len=512, workers=1, pool: Optional[PrimePool] = None) -> int:
+    p, q = generate_blum_factors(p_len, q_len, workers, pool)
+    return p * q
+
+
+def generate_blum_factors(p_len=512, q_len=512, workers=1, pool: Optional[PrimePool] = None) -> tuple[int, int]:
+    """ Generate both primes ≡ 3 (mod 4) at the same time, in a pool of workers processes if workers > 1
+        The primes are taken from the prime pool first if one is given, only the missing ones are searched for
+    """
+    specs = [PrimeSpec(p_len, 3, 4), PrimeSpec(q_len, 3, 4)]
+    if pool:
+        p, q = pool.draw(specs, workers)
+    else:
+        p, q = generate_primes([spec.as_tuple() for spec in specs], workers)
+    while p == q:
+        q = _generate_prime_congruent_to_3_mod_4(q_len)
+
+    console.print(f"[bold magenta]Generated blum integer:[/bold magenta] {p * q}")
+
+    return p, q
+
 
-def generate_blum_integer(p_len=512, q_len=512) -> int:
-    p = _generate_prime_congruent_to_3_mod_4(p_len)
-    q = _generate_prime_congruent_to_3_mod_4(q_len)
-    blum_int = p * q
+def write_blum_key(p: int, q: int, path: str = BLUM_KEY_PATH):
+    """ Store the factorization of the Blum integer, the file is created readable by the owner only """
+    with open_private(path) as f:
+        json.dump({"n": p * q, "p": p, "q": q}, f)
 
-    console.print(f"[bold magenta]Generated blum integer:[/bold magenta] {blum_int}")
 
-    return blum_int
+def read_blum_key(n: int, path: str = BLUM_KEY_PATH) -> Optional[tuple[int, int]]:
+    """ Read the factors of n from the private key file, None if missing or not matching n """
+    try:
+        with open(path, "r") as f:
+            key = json.load(f)
+    except FileNotFoundError:
+        return None
+    if key["p"] * key["q"] != n:
+        return None
+    return key["p"], key["q"]
 
 
 def _generate_prime_congruent_to_3_mod_4(length: int) -> int:
-    p = 0
-    while p % 4 != 3:
-        p = generate_prime_number(length)
-    return p
+    return generate_prime_number(length, residue=3, modulus=4)
@@ -0,0 +1,29 @@
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, Type
+
+
+def ordered_map(fn: Callable, iterable: Iterable, workers: int, window: int = 0,
+                executor: Type[Executor] = ProcessPoolExecutor) -> Iterator:
+    """ Lazily map fn over the iterable in a pool of workers, yielding the results in the input order
+        Args:
+            fn -- Callable -- picklable (module level) function applied to each item
+            iterable -- Iterable -- items, consumed only as fast as the results are yielded
+            workers -- int -- size of the pool
+            window -- int -- maximum number of tasks in flight, defaults to twice the pool size
+            executor -- Type[Executor] -- pool implementation
+        return iterator over fn(item) for each item
+    """
+    window = window or 2 * workers
+    pending = deque()
+    with executor(max_workers=workers) as pool:
+        try:
+            for item in iterable:
+                pending.append(pool.submit(fn, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,143 @@
+import os
+import threading
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from rich.console import Console
+
+from utils.prime import generate_primes
+from utils.private import open_private
+
+console = Console()
+
+POOL_PATH = "numbers/pool"
+
+
+@dataclass(frozen=True)
+class PrimeSpec:
+    """ Class of the pooled primes, p ≡ residue (mod modulus) of the given bit length """
+    length: int
+    residue: int = 1
+    modulus: int = 2
+
+    @property
+    def key(self) -> str:
+        return f"{self.length}.{self.residue}.{self.modulus}"
+
+    @staticmethod
+    def parse(key: str) -> "PrimeSpec":
+        length, residue, modulus = (int(v) for v in key.split("."))
+        return PrimeSpec(length, residue, modulus)
+
+    def as_tuple(self) -> tuple[int, int, int]:
+        return self.length, self.residue, self.modulus
+
+
+class PrimePool:
+    """ Pre-generated primes kept on disk, one file per prime in a directory per PrimeSpec
+
+        A prime is taken by renaming its file to a name unique to the taker, which is atomic, so that every prime
+        is handed out once even to concurrent processes; new primes are written to a temporary file first and
+        only become visible once complete
+    """
+
+    SUFFIX = ".prime"
+
+    def __init__(self, path: str = POOL_PATH):
+        self.path = Path(path)
+
+    def _dir(self, spec: PrimeSpec) -> Path:
+        directory = self.path.joinpath(spec.key)
+        directory.mkdir(parents=True, exist_ok=True)
+        return directory
+
+    def put(self, spec: PrimeSpec, prime: int):
+        directory = self._dir(spec)
+        name = uuid.uuid4().hex
+        tmp = directory.joinpath(f".{name}.tmp")
+        # the primes are future key factors, readable by the owner only
+        with open_private(tmp, exclusive=True) as f:
+            f.write(str(prime))
+        os.replace(tmp, directory.joinpath(name + self.SUFFIX))
+
+    def take(self, spec: PrimeSpec) -> Optional[int]:
+        """ Remove a prime from the pool, None if it is empty """
+        directory = self.path.joinpath(spec.key)
+        if not directory.is_dir():
+            return None
+        for entry in os.scandir(directory):
+            if not entry.name.endswith(self.SUFFIX):
+                continue
+            claimed = directory.joinpath(f".{entry.name}.{os.getpid()}.{uuid.uuid4().hex}.taken")
+            try:
+                os.rename(entry.path, claimed)
+            except FileNotFoundError:
+                # taken by someone else in the meantime
+                continue
+            with open(claimed, "r") as f:
+                prime = int(f.read())
+            os.unlink(claimed)
+            return prime
+        return None
+
+    def draw(self, specs: list[PrimeSpec], workers: int = 1) -> list[int]:
+        """ A prime for every spec, taken from the pool, the missing ones are searched for (in parallel) """
+        primes = [self.take(spec) for spec in specs]
+        missing = [i for i, p in enumerate(primes) if p is None]
+        if missing:
+            for i, p in zip(missing, generate_primes([specs[i].as_tuple() for i in missing], workers)):
+                primes[i] = p
+        return primes
+
+    def size(self, spec: PrimeSpec) -> int:
+        directory = self.path.joinpath(spec.key)
+        if not directory.is_dir():
+            return 0
+        return sum(1 for entry in os.scandir(directory) if entry.name.endswith(self.SUFFIX))
+
+    def specs(self) -> list[PrimeSpec]:
+        if not self.path.is_dir():
+            return []
+        return sorted((PrimeSpec.parse(entry.name) for entry in os.scandir(self.path) if entry.is_dir()),
+                      key=lambda s: (s.length, s.modulus, s.residue))
+
+    def refill(self, spec: PrimeSpec, watermark: int, workers: int = 1) -> int:
+        """ Top the pool of spec up to watermark primes
+            return the number of primes added
+        """
+        added = 0
+        # a batch per round, so that the primes become available while the rest is still being searched for
+        while (missing := watermark - self.size(spec)) > 0:
+            for prime in generate_primes([spec.as_tuple()] * min(missing, max(1, workers)), workers):
+                self.put(spec, prime)
+                added += 1
+        return added
+
+
+class RefillWorker(threading.Thread):
+    """ Background thread keeping the pools of the given specs at the watermark """
+
+    def __init__(self, pool: PrimePool, specs: list[PrimeSpec], watermark: int, interval: float = 1.0,
+                 workers: int = 1):
+        super().__init__(daemon=True)
+        self.pool = pool
+        self.specs = specs
+        self.watermark = watermark
+        self.interval = interval
+        self.workers = workers
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            for spec in self.specs:
+                if self._stopped.is_set():
+                    break
+                added = self.pool.refill(spec, self.watermark, self.workers)
+                if added:
+                    console.log(f"Added {added} primes to the {spec.key} pool")
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
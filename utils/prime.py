@@ -1,5 +1,29 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from math import gcd
 from random import randrange, getrandbits
+from typing import Iterator, Optional
+
+
+def _small_primes(limit: int) -> list[int]:
+    """ Sieve of Eratosthenes, all primes lower than limit """
+    sieve = bytearray([1]) * limit
+    sieve[0:2] = b"\x00\x00"
+    for i in range(2, int(limit ** 0.5) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, limit, i)))
+    return [i for i, is_prime in enumerate(sieve) if is_prime]
+
+
+# the first 2048 odd primes, used to sieve the candidates before running Miller-Rabin
+SIEVE_PRIMES = _small_primes(17900)[1:2049]
+
+# (minimum candidate length, Miller-Rabin rounds), FIPS 186-4 Table C.3, M-R tests only;
+# shorter candidates fall back to the worst case 4^-k error bound
+MILLER_RABIN_ROUNDS = [(1536, 3), (1024, 4), (512, 7), (0, 50)]
+
+
+def miller_rabin_rounds(length: int) -> int:
+    return next(rounds for min_length, rounds in MILLER_RABIN_ROUNDS if length >= min_length)
 
 
 def _is_prime(n, k=128) -> bool:
@@ -33,12 +57,115 @@ def _is_prime(n, k=128) -> bool:
     return True
 
 
-def generate_prime_number(length=1024) -> int:
-    p = 0
-    while not _is_prime(p, 128):
-        # apply a mask to set MSB and LSB to 1
-        p = getrandbits(length) | (1 << length - 1) | 1
-    return p
+def generate_prime_number(length=1024, residue=1, modulus=2) -> int:
+    """ Generate a random prime p ≡ residue (mod modulus) with its two most significant bits set
+        (for length >= 8), so that a product of two such primes has exactly the double length
+        Args:
+            length -- int -- bit length of the prime
+            residue -- int -- required residue of the prime
+            modulus -- int -- modulus of the congruence, the default one only asks for an odd number
+        return the prime
+    """
+    if length < 2:
+        raise ValueError(f"prime length must be at least 2 bits, was: {length}")
+    rounds = miller_rabin_rounds(length)
+    while True:
+        start, count = random_window(length, residue, modulus)
+        p = search_window(start, count, modulus, rounds)
+        if p:
+            return p
+
+
+def generate_primes(specs: list[tuple[int, int, int]], workers: int = 1) -> list[int]:
+    """ Generate a prime for every (length, residue, modulus) spec, all of them searched at the same time
+        Args:
+            specs -- list[tuple[int, int, int]] -- length, residue and modulus of each prime, see generate_prime_number
+            workers -- int -- size of the process pool, the primes are generated one by one in place if 1
+        return the primes in the order of the specs
+    """
+    if workers <= 1:
+        return [generate_prime_number(*spec) for spec in specs]
+
+    windows = [_disjoint_windows(*spec) for spec in specs]
+    rounds = [miller_rabin_rounds(length) for length, _, _ in specs]
+    found: list[Optional[int]] = [None] * len(specs)
+    pending: dict[Future, int] = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def fill():
+            # keep every worker busy with a speculative window of one of the primes still searched for
+            searched = [i for i, p in enumerate(found) if p is None]
+            while searched and len(pending) < 2 * workers:
+                i = min(searched, key=lambda s: sum(1 for j in pending.values() if j == s))
+                start, count = next(windows[i])
+                pending[pool.submit(search_window, start, count, specs[i][2], rounds[i])] = i
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                p = future.result()
+                if p and found[i] is None:
+                    found[i] = p
+                    # the first verified prime wins, windows of this spec which did not start yet are dropped
+                    for other, j in list(pending.items()):
+                        if j == i and other.cancel():
+                            del pending[other]
+            fill()
+
+    return found
+
+
+def _disjoint_windows(length: int, residue: int, modulus: int) -> Iterator[tuple[int, int]]:
+    """ Consecutive, non-overlapping windows following a random start, a new start is drawn at the top """
+    start, count = random_window(length, residue, modulus)
+    while True:
+        yield start, count
+        start += count * modulus
+        if start.bit_length() > length:
+            start, count = random_window(length, residue, modulus)
+        else:
+            count = min(count, ((1 << length) - 1 - start) // modulus + 1)
+
+
+def random_window(length: int, residue: int, modulus: int, size: int = 0) -> tuple[int, int]:
+    """ Pick a random start of a window of candidates start + i * modulus, all of them length bits long
+        return the start and the number of candidates in the window
+    """
+    size = size or max(64, 2 * length)
+    # apply a mask to set the two most significant bits to 1, just the top one for the tiny lengths
+    # for which the congruence could not be satisfied otherwise
+    start = getrandbits(length) | ((3 << length - 2) if length >= 8 else (1 << length - 1))
+    start += (residue - start) % modulus
+    upper = (1 << length) - 1
+    if start > upper:
+        start -= modulus
+    return start, min(size, (upper - start) // modulus + 1)
+
+
+def search_window(start: int, count: int, modulus: int, rounds: int) -> Optional[int]:
+    """ Find the first prime of the window start + i * modulus, i < count
+        Multiples of the small primes are crossed out first, so that only the survivors are tested
+        with Miller-Rabin
+    """
+    last = start + (count - 1) * modulus
+    composite = bytearray(count)
+    for p in SIEVE_PRIMES:
+        if p > last:
+            break
+        if modulus % p == 0:
+            continue
+        # the first index i for which p divides start + i * modulus
+        i = -start * pow(modulus, -1, p) % p
+        if start + i * modulus == p:
+            i += p
+        composite[i::p] = b"\x01" * len(range(i, count, p))
+
+    for i in range(count):
+        if not composite[i] and _is_prime(start + i * modulus, rounds):
+            return start + i * modulus
+    return None
 
 
 def generate_coprime_random_integer(p: int, length=512) -> int:
@@ -46,3 +173,23 @@ def generate_coprime_random_integer(p: int, length=512) -> int:
     while gcd(p, a) != 1:
         a = abs(getrandbits(length))
     return a
+
+
+def extended_gcd(a: int, b: int) -> tuple[int, int, int]:
+    """ Extended Euclidean algorithm
+        return g, x, y such that a·x + b·y = g = gcd(a, b)
+    """
+    x0, x1, y0, y1 = 1, 0, 0, 1
+    while b:
+        quotient, a, b = a // b, b, a % b
+        x0, x1 = x1, x0 - quotient * x1
+        y0, y1 = y1, y0 - quotient * y1
+    return a, x0, y0
+
+
+def modular_inverse(a: int, m: int) -> int:
+    """ The x in [0, m) for which a·x ≡ 1 (mod m), ValueError if a is not invertible modulo m """
+    g, x, _ = extended_gcd(a % m, m)
+    if g != 1:
+        raise ValueError(f"{a} is not invertible modulo {m}, gcd is {g}")
+    return x % m
@@ -0,0 +1,14 @@
+import os
+from pathlib import Path
+from typing import TextIO, Union
+
+
+def open_private(path: Union[str, Path], exclusive: bool = False) -> TextIO:
+    """ Open path for writing text, a file created by it is readable by the owner only, whatever the umask
+        Args:
+            path -- Union[str, Path] -- file holding key material
+            exclusive -- bool -- fail if the file exists instead of truncating it
+        return the file object
+    """
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if exclusive else os.O_TRUNC)
+    return os.fdopen(os.open(path, flags, 0o600), "w")